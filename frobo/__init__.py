@@ -1,2 +1,2 @@
 from . import kernel
-from .kernel import Cog, CogFeature, Core, utilities as util
\ No newline at end of file
+from .kernel import Cog, CogFeature, Core, Outcome, utilities as util
\ No newline at end of file
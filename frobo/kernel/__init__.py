@@ -1,2 +1,3 @@
 from .core import Core
 from .cog import Cog, CogFeature
+from .outcome import Outcome
@@ -1,4 +1,6 @@
 import enum
+import functools
+import types
 
 from frobo.kernel.registration import Registration
 from frobo.kernel.utilities import camel_to_snakecase, key_starts_with
@@ -41,21 +43,73 @@ class CogMeta(type):
         )
         for key, ann in getattr(cls, '__annotations__', {}).items():
             setattr(cls, key, ann)
+        # Resolved class attributes, set last so that the above is not cached
+        type.__setattr__(cls, '__resolved__', {})
         return cls
 
     def __getattribute__(self, key: str):
+        resolved = type.__getattribute__(self, '__dict__').get('__resolved__', None)
+        if resolved is not None and key in resolved:
+            return resolved[key]
         val = super().__getattribute__(key)
         if hasattr(val, '__get__'):
-            return val.__get__(self, self.__class__)
+            val = val.__get__(self, self.__class__)
+            if resolved is not None:
+                resolved[key] = val
         return val
 
+    def __setattr__(self, key: str, value):
+        resolved = type.__getattribute__(self, '__dict__').get('__resolved__', None)
+        if resolved is not None:
+            resolved.pop(key, None)
+        super().__setattr__(key, value)
+
+    def __delattr__(self, key: str):
+        resolved = type.__getattribute__(self, '__dict__').get('__resolved__', None)
+        if resolved is not None:
+            resolved.pop(key, None)
+        super().__delattr__(key)
+
+def is_resolution_cacheable(value) -> bool:
+    '''
+    Tell whether an attribute resolved on a cog may be reused until cogs are
+    mounted or unmounted: bound methods, registration handlers, models and
+    injected cogs, but never other injectables, like database sessions, that
+    must be produced anew on every access
+    '''
+    return isinstance(value, (types.MethodType, functools.partial, type, Cog))
+
 class Cog(metaclass=CogMeta):
     def __init__(self, module):
         self.module = module
         self.core = module.core
 
     def __getattribute__(self, key: str):
+        attributes = object.__getattribute__(self, '__dict__')
+        core = attributes.get('core', None)
+        resolved = attributes.get('__resolved__', None)
+        if resolved is not None:
+            entry = resolved.get(key, None)
+            # Entries only hold while the set of mounted cogs stays the same,
+            # drop them all at once so stale ones do not keep unmounted cogs
+            if entry is not None and entry[0] == core.generation:
+                return entry[1]
+            elif entry is not None:
+                resolved.clear()
+
         val = super().__getattribute__(key)
         if hasattr(val, '__get__'):
-            return val.__get__(self, self.__class__)
-        return val
\ No newline at end of file
+            val = val.__get__(self, self.__class__)
+        if core is not None and key not in attributes and not key.startswith('__') and is_resolution_cacheable(val):
+            if resolved is None:
+                resolved = attributes['__resolved__'] = {}
+            resolved[key] = (core.generation, val)
+        return val
+
+    def __setattr__(self, key: str, value):
+        object.__getattribute__(self, '__dict__').get('__resolved__', {}).pop(key, None)
+        super().__setattr__(key, value)
+
+    def __delattr__(self, key: str):
+        object.__getattribute__(self, '__dict__').get('__resolved__', {}).pop(key, None)
+        super().__delattr__(key)
\ No newline at end of file
@@ -1,20 +1,40 @@
 import asyncio
 import functools
+import importlib
 import itertools
+import json
 import os
 import sys
-from collections.abc import Awaitable
+import time
+import zipfile
+from collections.abc import Awaitable, Callable
 from pathlib import Path
 from typing import Any, Iterator, NoReturn, Optional, Union
 
 from .cog import Cog, CogFeature, CogMeta
 from .exc import BadModule, ProcessTerminated
-from .module import Module
+from .module import Module, loading_modules, unloading_modules
+from .outcome import Outcome
 from .registration import Registration
+from .scheduler import Scheduler
 from .utilities import Key, is_dict_subset, is_list_prefix
 
 CORE_PATH = Path(__file__).parent.parent
 
+def new_event_loop(backend: str) -> asyncio.AbstractEventLoop:
+    '''
+    Create an event loop from the module named by backend, such as asyncio or
+    uvloop, falling back to asyncio when that module is not installed
+    '''
+    try:
+        module = importlib.import_module(backend)
+    except ImportError:
+        print(f'\033[91;1mEvent loop backend {backend} is not installed, using asyncio\033[0m')
+        module = asyncio
+    loop = module.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
 class Core:
     '''
     Manages modules, cogs and communication between them
@@ -22,12 +42,18 @@ class Core:
     Decorators:
         core.event: Registers a handler on the common event system
             By the nature of this system, events may have multiple handlers
+            A `timeout` keyword bounds how long the handler may run, as the
+            `timeout` argument of Core.invoke does for all handlers
 
         core.injectable: Defines an injectable that may be used as a function or
             class annotation, ensuring the presence of these values if possible
 
         core.transform: Defines a transform to apply to registrations of a
-            specific types
+            specific types, those of cogs with fewer dependencies first
+
+        core.periodic: Runs a handler in the background every `interval`
+            seconds, plus up to `jitter` random seconds, while its cog is
+            mounted
 
     Events:
         core.mount: Fired for the concerned module when it has been inserted in
@@ -41,28 +67,59 @@ class Core:
 
         core.unmount: Fired for the concerned module before it is removed from
         the core
+
+        core.started: Fired once the modules or cogs to start with are all
+        mounted, before running the command line
     '''
 
+    backend: Optional[str]
+    bundles: dict[Path, dict[tuple[str, ...], dict[str, Any]]]
     cogs: dict[tuple[str], Cog]
+    depths: tuple[int, dict[Key, int]]
+    generation: int
     loop: asyncio.AbstractEventLoop
     modules: dict[tuple[str], Module]
     path: list[Path]
+    scheduler: Scheduler
+    started: bool
+    unmount_timeout: float
 
-    def __init__(self, path: list[Path]=[], loop: Optional[asyncio.AbstractEventLoop]=None):
+    def __init__(
+        self,
+        path: list[Path]=[],
+        loop: Union[asyncio.AbstractEventLoop, str, None]=None,
+        unmount_timeout: float=30.0,
+    ):
+        # Loops can be given by the name of their backend, see new_event_loop
+        self.backend = loop if isinstance(loop, str) else None
+        if isinstance(loop, str):
+            loop = new_event_loop(loop)
+        self.bundles = {}
         self.cogs = {}
+        # The generation dependency depths were computed for, and the depths
+        self.depths = (0, {})
+        # Bumped whenever cogs are mounted or unmounted, see Cog.__getattribute__
+        self.generation = 0
         self.loop = loop or asyncio.get_event_loop()
         self.modules = {}
         self.path = path.copy()
-        self.path.append(CORE_PATH / 'modules')
-
-    def run(self, args: list[str]=sys.argv[1:], exit: bool=True) -> Union[NoReturn, int]:
+        self.scheduler = Scheduler(self)
+        self.started = False
+        self.unmount_timeout = unmount_timeout
+        # Bundles already contain the core modules
+        if CORE_PATH / 'modules' not in self.path and not any(p.is_file() for p in self.path):
+            self.path.append(CORE_PATH / 'modules')
+
+    def run(self, args: list[str]=sys.argv[1:], exit: bool=True, cogs: Optional[list[Key]]=None) -> Union[NoReturn, int]:
         '''
         Index all modules and starts running forever, unless a module exits the
         program or Ctrl-C is hit, ensures proper shutdown too
+
+        If cogs are provided, only mount those instead of indexing modules
         '''
         code = 0
         try:
-            self.loop.run_until_complete(self._start(args))
+            self.loop.run_until_complete(self._start(args, cogs))
             self.loop.run_forever()
         except ProcessTerminated as e:
             code = e.code
@@ -75,14 +132,67 @@ class Core:
         else:
             return code
 
-    async def _start(self, args=sys.argv[1:]):
-        await self.index_modules()
+    async def _start(self, args=sys.argv[1:], cogs=None):
+        if cogs is None:
+            await self.index_modules()
+        else:
+            for name in cogs:
+                await self.mount_cog(name)
         cli = await self.mount_cog('cli.parser')
+        self.started = True
+        await self.emit('core.started')
 
         await cli.run(*args)
 
     async def _close(self) -> Awaitable[None]:
-        await self.gather(map(self.unmount_cog, self.cogs))
+        '''
+        Unmount all cogs, each one once all cogs depending on it are unmounted,
+        so that independent cogs are unmounted concurrently
+        '''
+        waits = self.shutdown_order()
+        tasks = {}
+
+        async def unmount(name):
+            await self.gather(map(tasks.get, waits[name]), return_exceptions=True)
+            try:
+                await self.modules[name[:-1]].unmount_cog(name[-1], closing=True)
+            except Exception as e:
+                print(f'\033[91;1mCould not unmount {".".join(name)}: {e.__class__.__name__}: {e}\033[0m')
+
+        for name in waits:
+            tasks[name] = self.loop.create_task(unmount(name))
+        await self.gather(tasks.values(), return_exceptions=True)
+
+    def shutdown_order(self) -> dict[tuple[str, ...], set[tuple[str, ...]]]:
+        '''
+        Map every mounted cog to the cogs that must be unmounted before it,
+        which are the ones depending on it, ignoring dependency cycles
+        '''
+        dependents = {name: set() for name in self.cogs}
+        for name, cog in self.cogs.items():
+            for dep in cog.dependencies:
+                # Dependencies may designate a cog or a whole module
+                for target in self.cogs:
+                    if target != name and target[:len(dep)] == dep:
+                        dependents[target].add(name)
+
+        waits = {}
+        visiting = set()
+        def visit(name):
+            visiting.add(name)
+            waits[name] = set()
+            for dependent in dependents[name]:
+                if dependent in visiting:
+                    continue
+                if dependent not in waits:
+                    visit(dependent)
+                waits[name].add(dependent)
+            visiting.remove(name)
+
+        for name in dependents:
+            if name not in waits:
+                visit(name)
+        return waits
 
     def exit(self, code: int=0) -> NoReturn:
         '''
@@ -93,14 +203,27 @@ class Core:
 
     async def index_modules(self) -> Awaitable[None]:
         '''
-        Search for cogs in all directories of the path.
+        Search for cogs in all entries of the path and load them
+        '''
+        for base, path, name in self.discover_modules():
+            await self.load_module(path, name)
+
+    def discover_modules(self) -> Iterator[tuple[Path, Path, tuple[str, ...]]]:
+        '''
+        Find the base, path and name of all modules in the path, in load order
 
-        Locates any Python packages (directories with an __init__.py) or modules
-        outside of a package and attempts to load them.
+        Directories are searched for Python packages (directories with an
+        __init__.py) or modules outside of a package, while bundles built by the
+        bundle command list their modules in their manifest
         '''
 
-        excluded = set()
         for base in self.path:
+            if base.is_file():
+                for name, entry in self.bundle(base).items():
+                    yield base, base / entry['path'], name
+                continue
+
+            excluded = set()
             for path, _, files in os.walk(base):
                 path = Path(path)
                 if path.name == '__pycache__':
@@ -111,12 +234,24 @@ class Core:
                 if any(path.is_relative_to(p) for p in excluded):
                     continue
                 if '__init__.py' in files:
-                    await self.load_module(path / '__init__.py', relative_path.parts)
+                    yield base, path / '__init__.py', relative_path.parts
                     excluded.add(path)
                 else:
                     for file in files:
+                        if not file.endswith('.py'):
+                            continue
                         name = (relative_path / file).with_suffix('').parts
-                        await self.load_module(path / file, name)
+                        yield base, path / file, name
+
+    def bundle(self, base: Path) -> dict[tuple[str, ...], dict[str, Any]]:
+        '''
+        Return the modules listed in the manifest of a bundle, by name
+        '''
+        if base not in self.bundles:
+            with zipfile.ZipFile(base) as archive:
+                manifest = json.loads(archive.read('manifest.json'))
+            self.bundles[base] = {tuple(entry['name']): entry for entry in manifest['modules']}
+        return self.bundles[base]
 
     async def load_module(self, path: Optional[Path]=None, name: Optional[Key]=None) -> Awaitable[Module]:
         '''
@@ -127,7 +262,7 @@ class Core:
             name = tuple(name.split('.'))
         if name in self.modules:
             return self.modules[name]
-        return await self.reload_module(name=name)
+        return await self.reload_module(path=path, name=name)
 
     async def reload_module(self, path: Optional[Path]=None, name: Optional[Key]=None) -> Awaitable[Module]:
         '''
@@ -150,6 +285,12 @@ class Core:
             if isinstance(name, str):
                 name = tuple(name.split('.'))
             for base in self.path:
+                if base.is_file():
+                    entry = self.bundle(base).get(name, None)
+                    if entry is not None:
+                        path = base / entry['path']
+                        break
+                    continue
                 base = base.resolve()
                 pkg_path = base / Path(*name) / '__init__.py'
                 mod_path = (base / Path(*name)).with_suffix('.py')
@@ -161,14 +302,17 @@ class Core:
             if path is None:
                 raise BadModule('Cannot determine module source')
         if name in self.modules:
-            await self.unload_module(self.modules[name])
-        mod = self.modules[name] = Module(self, path, name)
-        await mod.autoload()
+            await self.unload_module(self.modules[name], reloading=True)
+        archive = next((base for base in self.path if base.is_file() and path.is_relative_to(base)), None)
+        mod = self.modules[name] = Module(self, path, name, archive)
+        mod.autoloading = self.loop.create_task(mod.autoload())
+        await mod.autoloading
         return mod
 
-    async def unload_module(self, name: Union[Module, Key]) -> Awaitable[None]:
+    async def unload_module(self, name: Union[Module, Key], reloading: bool=False) -> Awaitable[None]:
         '''
-        Forget a module after unloading all of its loaded cogs
+        Forget a module after unloading all of its loaded cogs, which can tell
+        from unloading_modules whether it is about to be loaded again
         '''
         if isinstance(name, str):
             name = tuple(name.split('.'))
@@ -178,8 +322,13 @@ class Core:
             mod = self.modules[name]
         else:
             mod, name = name, name.name
-        await self.gather(map(self.unmount_cog, mod.required_by))
-        await self.gather(map(mod.unmount_cog, mod.cogs))
+        unloading = unloading_modules.get() if reloading else (*unloading_modules.get(), name)
+        token = unloading_modules.set(unloading)
+        try:
+            await self.gather(map(self.unmount_cog, mod.required_by))
+            await self.gather(map(mod.unmount_cog, mod.cogs))
+        finally:
+            unloading_modules.reset(token)
         del self.modules[name]
 
     async def mount_cog(self, name: Union[CogMeta, Key]) -> Awaitable[Cog]:
@@ -195,7 +344,12 @@ class Core:
             try:
                 mod = await self.load_module(name=name[:-1])
             except BadModule:
-                return await self.load_module(name=name)
+                mod = await self.load_module(name=name)
+                # The module may still be mounting its cogs for someone else,
+                # unless it is loading us, in which case it would never finish
+                if mod.name not in loading_modules.get():
+                    await asyncio.shield(mod.autoloading)
+                return mod
             name = name[-1]
 
         return await mod.mount_cog(name)
@@ -279,6 +433,61 @@ class Core:
         for cog, reg in found_registrations:
             yield Registration(reg.name, reg.args, reg.kwargs, reg.raw, reg.__get__(cog, cog.__class__, context_injectables))
 
+    def dependency_depth(self, name: Key, seen: tuple[Key, ...]=()) -> int:
+        '''
+        Return the length of the longest chain of mounted dependencies below a
+        cog, ignoring dependency cycles
+
+        Depths are remembered until cogs are mounted or unmounted, only for
+        the cogs they are asked for, since those found below one depend on
+        the chain that led to them when there are cycles
+        '''
+        if len(seen) == 0:
+            if self.depths[0] != self.generation:
+                self.depths = (self.generation, {})
+            if name in self.depths[1]:
+                return self.depths[1][name]
+        cog = self.cogs.get(name, None)
+        if cog is None:
+            return 0
+        depth = 0
+        for dep in cog.dependencies:
+            # Dependencies may designate a cog or a whole module
+            for target in self.cogs:
+                if target != name and target[:len(dep)] == dep and target not in seen:
+                    depth = max(depth, 1 + self.dependency_depth(target, (*seen, name)))
+        if len(seen) == 0:
+            self.depths[1][name] = depth
+        return depth
+
+    def transforms(self, name: Key) -> list[Registration]:
+        '''
+        Find the transforms to apply to registrations of a given name, those
+        of cogs with the fewest dependencies below them first, so that the
+        order they are applied in does not depend on the order cogs were
+        mounted in
+        '''
+        if isinstance(name, tuple):
+            name = '.'.join(name)
+        providers = sorted(self.cogs, key=lambda qualname: (self.dependency_depth(qualname), qualname))
+        return [
+            transform
+            for qualname in providers
+            for transform in self.registered('core.transform', name, only=[qualname])
+        ]
+
+    def locate(self, filename: str, lineno: Optional[int]=None) -> Optional[Key]:
+        '''
+        Find the qualified name of the cog defining a source line, or of its
+        module if no cog does, returning None for code outside of modules
+        '''
+        for name, mod in self.modules.items():
+            if mod.filename != filename:
+                continue
+            cog = mod.locate(lineno) if lineno is not None else None
+            return cog.qualname if cog is not None else name
+        return None
+
     def injectable(self, reg: Registration, context: Optional[dict[Key, Any]]={}) -> Any:
         for key, value in context.items():
             if isinstance(key, str):
@@ -305,11 +514,32 @@ class Core:
         only: Optional[list[Key]]=None,
         without: Optional[list[Key]]=None,
         skip_unmounted: bool=True,
+        timeout: Optional[float]=None,
+        outcomes: bool=False,
         **kwargs
     ) -> Awaitable[list[Any]]:
-        return await self.gather(map(
+        '''
+        Call all matching registrations concurrently and return their results
+
+        Handlers are cancelled once they run for longer than `timeout`, or the
+        `timeout` keyword of their registration, whichever is lower. When
+        `outcomes` is set, an Outcome is returned for every handler instead of
+        raising the first exception or timeout, so that the results of the
+        other handlers are kept
+        '''
+        def call(reg):
+            deadlines = [t for t in (timeout, reg.kwargs.get('timeout', None)) if t is not None]
+            result = reg.wrapped(*handler_args, **handler_kwargs)
+            if len(deadlines) > 0:
+                result = asyncio.wait_for(result, min(deadlines))
+            return result
 
-            lambda x: x.wrapped(*handler_args, **handler_kwargs),
+        def call_outcome(reg):
+            # Injecting arguments may fail too, so call from within the outcome
+            return self.outcome(reg, call, reg)
+
+        return await self.gather(map(
+            call_outcome if outcomes else call,
             self.registered(
                 name,
                 *filter_args,
@@ -321,6 +551,19 @@ class Core:
             ),
         ), **kwargs)
 
+    async def outcome(self, reg: Registration, fn: Callable[..., Awaitable[Any]], *args) -> Awaitable[Outcome]:
+        outcome = Outcome(reg)
+        start = time.perf_counter()
+        try:
+            outcome.value = await fn(*args)
+        except asyncio.TimeoutError as e:
+            outcome.exception = e
+            outcome.timed_out = True
+        except Exception as e:
+            outcome.exception = e
+        outcome.elapsed = time.perf_counter() - start
+        return outcome
+
     async def emit(
         self,
         name: Key,
@@ -332,6 +575,8 @@ class Core:
         only: Optional[list[Key]]=None,
         without: Optional[list[Key]]=None,
         skip_unmounted: bool=True,
+        timeout: Optional[float]=None,
+        outcomes: bool=False,
         **kwargs,
     ) -> NotImplemented:
         if isinstance(name, tuple):
@@ -346,5 +591,20 @@ class Core:
             only=only,
             without=without,
             skip_unmounted=skip_unmounted,
+            timeout=timeout,
+            outcomes=outcomes,
             **kwargs,
-        )
\ No newline at end of file
+        )
+
+def run_child(
+    path: list[Path],
+    args: list[Any],
+    cogs: list[Key],
+    backend: Optional[str]=None,
+    unmount_timeout: float=30.0,
+) -> NoReturn:
+    '''
+    Entry point for child processes, running a fresh core from the same path,
+    loop backend and unmount timeout that only mounts the provided cogs
+    '''
+    Core(path, loop=backend, unmount_timeout=unmount_timeout).run(args, cogs=cogs)
@@ -1,42 +1,112 @@
+import asyncio
+import contextvars
+import dis
 import importlib as imp
+import importlib.machinery, importlib.util
+import zipimport
 from pathlib import Path
-from typing import Awaitable, Union
+from typing import Awaitable, Optional, Union
 
 from .cog import Cog, CogFeature, CogMeta
+from .registration import Registration
 from .utilities import Key, camel_to_snakecase
 
+# The modules being autoloaded and the cogs being mounted by the current task
+# and the ones it is waiting for, to tell dependency cycles from concurrent mounts
+loading_modules = contextvars.ContextVar('loading_modules', default=())
+mounting_cogs = contextvars.ContextVar('mounting_cogs', default=())
+# The modules being unloaded for good rather than reloaded by the current task,
+# for cogs to tell whether the cogs unmounting may come back
+unloading_modules = contextvars.ContextVar('unloading_modules', default=())
+
+def line_span(cls: type) -> Optional[tuple[int, int]]:
+    '''
+    Return the first and last source lines of the methods of a class,
+    registration handlers included
+    '''
+    lines = []
+    for value in vars(cls).values():
+        if isinstance(value, Registration):
+            value = value.raw
+        value = getattr(value, '__func__', value)
+        code = getattr(value, '__code__', None)
+        if code is not None:
+            lines.append(code.co_firstlineno)
+            lines.extend(line for _, line in dis.findlinestarts(code))
+    if len(lines) == 0:
+        return None
+    return min(lines), max(lines)
+
 class Module:
     '''
     Represents a loaded Python module
 
     Automatically loads module and all of its cogs on construction
+
+    Modules from a bundle are loaded from their precompiled bytecode, without
+    going through the import system so that they stay out of sys.modules
     '''
 
+    archive:     Optional[Path]
+    autoloading: Optional[asyncio.Task]
     cogs:        dict[str, Cog]
     core:        'Core'
+    filename:    str
+    mounting:    dict[str, asyncio.Future]
     name:        tuple[str, ...]
     path:        Path
     spec:        imp._bootstrap.ModuleSpec
     module:      'module'
     required_by: list[Key]
+    spans:       dict[str, Optional[tuple[int, int]]]
 
-    def __init__(self, core: 'Core', path: Path, name: tuple[str, ...]):
+    def __init__(self, core: 'Core', path: Path, name: tuple[str, ...], archive: Optional[Path]=None):
+        self.archive = archive
+        self.autoloading = None
         self.cogs = {}
         self.core = core
+        self.mounting = {}
         self.name = name
         self.path = path
         self.required_by = []
+        self.spans = {}
 
         if isinstance(name, tuple):
             name = '.'.join(name)
-        self.spec = imp.util.spec_from_file_location(name, path)
-        self.module = imp.util.module_from_spec(self.spec)
-        self.spec.loader.exec_module(self.module)
+        if archive is None:
+            self.spec = imp.util.spec_from_file_location(name, path)
+            self.module = imp.util.module_from_spec(self.spec)
+            self.spec.loader.exec_module(self.module)
+            self.filename = str(path)
+        else:
+            package = path.stem == '__init__'
+            # zipimport looks modules up by the last part of their name only
+            loader = zipimport.zipimporter(str(path.parent.parent if package else path.parent))
+            self.spec = imp.machinery.ModuleSpec(name, loader, origin=str(path), is_package=package)
+            self.spec.has_location = True
+            self.module = imp.util.module_from_spec(self.spec)
+            code = loader.get_code(name)
+            # Code keeps the path of the source the bundle was built from
+            self.filename = code.co_filename
+            exec(code, vars(self.module))
+
+    def locate(self, lineno: int) -> Optional[Cog]:
+        '''
+        Find the mounted cog whose methods span a line of this module
+        '''
+        for cog_name, cog in self.cogs.items():
+            if cog_name not in self.spans:
+                self.spans[cog_name] = line_span(type(cog))
+            span = self.spans[cog_name]
+            if span is not None and span[0] <= lineno <= span[1]:
+                return cog
+        return None
 
     async def autoload(self) -> Awaitable[None]:
         '''
         Finds all autoloadable cogs in module and loads them
         '''
+        loading_modules.set((*loading_modules.get(), self.name))
         for _, value in vars(self.module).items():
             if not isinstance(value, CogMeta):
                 continue
@@ -47,8 +117,8 @@ class Module:
     async def mount_cog(self, cog_name: Union[str, CogMeta]) -> Awaitable[Cog]:
         '''
         Mount a cog from this module by name or class after loading its
-        dependencies, then fire the core.mount event for that cog, and the
-        core.mounted event for all others
+        dependencies, then fire the core.mount event for that cog, start its
+        periodic jobs, and fire the core.mounted event for all others
         '''
         if isinstance(cog_name, str):
             cog_class = next(filter(
@@ -57,21 +127,49 @@ class Module:
             ))
         else:
             cog_class, cog_name = cog_name, cog_name.name
+        if cog_name in self.mounting:
+            if (*self.name, cog_name) in mounting_cogs.get():
+                raise RuntimeError(f'Cog {".".join((*self.name, cog_name))} depends on itself')
+            # Cogs sharing a dependency mount it concurrently, only do it once
+            return await asyncio.shield(self.mounting[cog_name])
         if cog_name not in self.cogs:
-            await self.core.gather(map(lambda name: self.core._ensure(name, (*self.name, cog_name)), cog_class.dependencies))
-            self.cogs[cog_name] = self.core.cogs[(*self.name, cog_name)] = cog = cog_class(self)
-            await self.core.emit('core.mount', only=[cog.qualname], skip_unmounted=False)
-            cog.mounted = True
-            await self.core.emit('core.mounted', cog, without=[cog.qualname])
+            self.mounting[cog_name] = mounting = self.core.loop.create_future()
+            token = mounting_cogs.set((*mounting_cogs.get(), (*self.name, cog_name)))
+            try:
+                await self.core.gather(map(lambda name: self.core._ensure(name, (*self.name, cog_name)), cog_class.dependencies))
+                self.cogs[cog_name] = self.core.cogs[(*self.name, cog_name)] = cog = cog_class(self)
+                self.core.generation += 1
+                await self.core.emit('core.mount', only=[cog.qualname], skip_unmounted=False)
+                cog.mounted = True
+                self.core.scheduler.start(cog)
+                await self.core.emit('core.mounted', cog, without=[cog.qualname])
+                mounting.set_result(cog)
+            except asyncio.CancelledError as e:
+                mounting.cancel()
+                raise e
+            except Exception as e:
+                mounting.set_exception(e)
+                # Whoever started the mount reports the error
+                mounting.exception()
+                raise e
+            finally:
+                mounting_cogs.reset(token)
+                del self.mounting[cog_name]
         return self.cogs[cog_name]
 
 
-    async def unmount_cog(self, cog_name: Union[str, CogMeta, Cog]) -> Awaitable[None]:
+    async def unmount_cog(self, cog_name: Union[str, CogMeta, Cog], closing: bool=False) -> Awaitable[None]:
         '''
         Unmount a cog from this module after unloading all modules depending on
         it, untagging it from all its dependencies and firing the 
         core.unmount and core.unmounting for, respectively, the unmounted module
         and all others
+
+        When the core is closing, dependents are already gone and there is no
+        one left to notify, so both steps are skipped
+
+        The core.unmount handlers are cancelled if they run for longer than the
+        core's unmount timeout
         '''
 
         if isinstance(cog_name, CogMeta):
@@ -83,15 +181,24 @@ class Module:
         else:
             cog, cog_name = cog_name, cog_name.name
 
-        await self.core.gather(map(self.core.unmount_cog, cog.required_by))
-        for dep_name in cog.dependencies:
-            dep = self.cogs.get(dep_name, None)
-            if dep is not None:
-                dep.required_by.remove(cog)
-        await self.core.emit('core.unmounting', cog, without=[cog_name])
-        await self.core.emit('core.unmount', only=[cog_name])
+        if not closing:
+            await self.core.gather(map(self.core.unmount_cog, list(cog.required_by)))
+        for holder in [*self.core.cogs.values(), *self.core.modules.values()]:
+            if cog.qualname in holder.required_by:
+                holder.required_by[:] = [key for key in holder.required_by if key != cog.qualname]
+        await self.core.scheduler.stop(cog)
+        if not closing:
+            await self.core.emit('core.unmounting', cog, without=[cog.qualname])
+        try:
+            await asyncio.wait_for(self.core.emit('core.unmount', only=[cog.qualname]), self.core.unmount_timeout)
+        except asyncio.TimeoutError:
+            print(f'\033[91;1mCog {".".join(cog.qualname)} took more than {self.core.unmount_timeout}s to unmount, cancelled\033[0m')
+        cog.mounted = False
+        # Let go of the cogs it resolved, in case something still holds it
+        object.__getattribute__(cog, '__dict__').pop('__resolved__', None)
         try:
             del self.cogs[cog_name]
             del self.core.cogs[(*self.name, cog_name)]
         except KeyError:
-            pass
\ No newline at end of file
+            pass
+        self.core.generation += 1
\ No newline at end of file
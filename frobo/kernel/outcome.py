@@ -0,0 +1,21 @@
+import dataclasses
+from typing import Any, Optional
+
+from .registration import Registration
+
+@dataclasses.dataclass
+class Outcome:
+    '''
+    How a handler called through Core.invoke ended: with a value, an
+    exception, or by running past its deadline
+    '''
+
+    registration: Registration
+    value:        Any=None
+    exception:    Optional[BaseException]=None
+    timed_out:    bool=False
+    elapsed:      float=0
+
+    @property
+    def ok(self) -> bool:
+        return self.exception is None and not self.timed_out
@@ -23,6 +23,21 @@ class Registration:
         elif self.raw is id:
             return instance.core.injectable(self, context=context)
 
+        # Wrappers belong to the cog instance rather than to this class-level
+        # registration, so that mounting the class again wraps handlers anew
+        wrappers = object.__getattribute__(instance, '__dict__').setdefault('__wrappers__', {})
+        _wrapped = wrappers.get(id(self), None)
+        if _wrapped is None:
+            _wrapped = wrappers[id(self)] = self.wrap(instance)
+        if callable(_wrapped) and not isinstance(self.raw, type):
+            return functools.partial(_wrapped, __context__=context)
+        return _wrapped
+
+    def wrap(self, instance) -> Any:
+        '''
+        Bind the handler to a cog instance and its injected values, then apply
+        the transforms registered for this registration's name
+        '''
         _wrapped = wrapped = self.raw
         if not isinstance(self.raw, type) and callable(wrapped):
             @functools.wraps(self.raw)
@@ -36,14 +51,8 @@ class Registration:
                         bind_kwargs[key] = instance.core.injectable(value, context=__context__)
                 return wrapped(*bind_args, *args, **bind_kwargs, **kwargs)
         if len(self.name) != 0 and self.name[0] != 'core':
-            # TODO: Sort transforms by dependency order
-            for transform in instance.core.registered('core.transform', '.'.join(self.name)):
+            for transform in instance.core.transforms('.'.join(self.name)):
                 _wrapped = transform.wrapped(self, _wrapped, *self.args, **self.kwargs)
-        
-
-        self.wrapped = _wrapped
-        if callable(_wrapped) and not isinstance(self.raw, type):
-            return functools.partial(_wrapped, __context__=context)
         return _wrapped
 
     def __getattr__(self, key: str) -> 'Registration':
@@ -0,0 +1,109 @@
+import asyncio
+import dataclasses
+import inspect
+import random
+import time
+import traceback
+from typing import Any, Awaitable, Optional
+
+from .registration import Registration
+from .utilities import Histogram, Key
+
+@dataclasses.dataclass
+class Job:
+    '''
+    A core.periodic registration of a mounted cog, with its run statistics
+    '''
+
+    cog:          'Cog'
+    registration: Registration
+    interval:     float
+    jitter:       float=0
+    runs:         int=0
+    failures:     int=0
+    running:      bool=False
+    last_run:     Optional[float]=None
+    durations:    Histogram=dataclasses.field(default_factory=Histogram)
+    task:         Optional[asyncio.Task]=None
+
+    @property
+    def name(self) -> str:
+        return '.'.join((*self.cog.qualname, self.registration.raw.__name__))
+
+    def delay(self) -> float:
+        return self.interval + random.uniform(0, self.jitter)
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            'interval': self.interval,
+            'runs':     self.runs,
+            'failures': self.failures,
+            'running':  self.running,
+            'last_run': self.last_run,
+            'duration': self.durations.summary(),
+        }
+
+class Scheduler:
+    '''
+    Runs the core.periodic registrations of mounted cogs in the background
+
+    Each job waits for its interval, plus a random delay of up to its jitter,
+    between the end of a run and the start of the next one, so runs of the
+    same job never overlap
+    '''
+
+    core: 'Core'
+    jobs: dict[Key, list[Job]]
+
+    def __init__(self, core: 'Core'):
+        self.core = core
+        self.jobs = {}
+
+    def start(self, cog: 'Cog') -> None:
+        '''
+        Start the jobs registered by a cog that just got mounted
+        '''
+        jobs = []
+        for reg in self.core.registered('core.periodic', only=[cog.qualname]):
+            job = Job(cog, reg, reg.kwargs.get('interval', 60), reg.kwargs.get('jitter', 0))
+            job.task = self.core.loop.create_task(self.run(job))
+            jobs.append(job)
+        if len(jobs) != 0:
+            self.jobs[cog.qualname] = jobs
+
+    async def stop(self, cog: 'Cog') -> Awaitable[None]:
+        '''
+        Cancel the jobs of a cog that is being unmounted, waiting for them to
+        finish
+        '''
+        jobs = self.jobs.pop(cog.qualname, [])
+        for job in jobs:
+            job.task.cancel()
+        await self.core.gather(map(lambda job: job.task, jobs), return_exceptions=True)
+
+    async def run(self, job: Job) -> Awaitable[None]:
+        while True:
+            await asyncio.sleep(job.delay())
+            job.running = True
+            start = time.perf_counter()
+            try:
+                result = job.registration.wrapped()
+                if inspect.isawaitable(result):
+                    await result
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception:
+                job.failures += 1
+                print(f'\033[91;1mPeriodic job {job.name} failed\033[0m')
+                traceback.print_exc()
+            finally:
+                job.running = False
+                job.runs += 1
+                job.last_run = time.time()
+                job.durations.observe(time.perf_counter() - start)
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        '''
+        Return run statistics for every scheduled job
+        '''
+        return {job.name: job.summary() for jobs in self.jobs.values() for job in jobs}
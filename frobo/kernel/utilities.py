@@ -1,3 +1,4 @@
+import bisect
 import string
 import typing
 
@@ -24,4 +25,51 @@ def key_starts_with(key, prefix):
         key = key.split('.')
     if isinstance(prefix, str):
         prefix = prefix.split('.')
-    return is_list_prefix(prefix, key)
\ No newline at end of file
+    return is_list_prefix(prefix, key)
+
+class Histogram:
+    '''
+    Counts observations in fixed buckets, keeping memory constant, and
+    estimates percentiles from them
+    '''
+
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds: tuple[float, ...]=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> typing.Optional[float]:
+        '''
+        Return the upper bound of the bucket holding the q-th quantile, q
+        being between 0 and 1
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict[str, typing.Any]:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count > 0 else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
@@ -6,10 +6,12 @@ class Command(frobo.Cog):
 
     cli: cli.parser
 
-    @cli.command('autorun', 'Run init if it never has been, then start')
+    @cli.command('autorun', 'Run init if it never has been, migrate otherwise, then start')
     async def autorun(self):
         path = pathlib.Path.cwd() / '.frobo_initialized'
         if not path.exists():
             path.touch()
             await self.cli.run('init', should_exit=False, terse=True)
+        else:
+            await self.cli.run('migrate', should_exit=False, terse=True)
         await self.cli.run('start', terse=True)
\ No newline at end of file
@@ -0,0 +1,453 @@
+import aiohttp, aiohttp.web
+import asyncio
+import collections
+import dataclasses
+import datetime
+import discord.http
+import frobo
+import json
+import jwt
+import random
+import re
+import socket
+import sqlalchemy, sqlalchemy.orm
+import threading
+import time
+import urllib.parse
+
+KEY_ID = 'bench'
+CLIENT_ID = 'bench'
+EMAIL_DOMAIN = 'bench.invalid'
+
+def print_routes(stats, elapsed):
+    print(f'{"Route":36s} {"Requests":>8s} {"Req/s":>8s} {"p50":>9s} {"p99":>9s} {"Errors":>7s}')
+    for route, (histogram, errors) in stats.items():
+        summary = histogram.summary()
+        if summary['count'] == 0:
+            continue
+        print(
+            f'{route:36s} {summary["count"]:8d} {summary["count"] / elapsed:8.1f}'
+            f' {summary["p50"] * 1000:7.2f}ms {summary["p99"] * 1000:7.2f}ms {errors:7d}'
+        )
+
+def json_response(data):
+    # discord.py only decodes bodies whose content type has no charset
+    return aiohttp.web.Response(body=json.dumps(data).encode(), content_type='application/json')
+
+class StandIns:
+    '''
+    Serves the Microsoft signing keys, the Epitech intra and the Discord users
+    API locally, from a thread of its own since the JWKS client blocks the loop
+    it is called from
+    '''
+
+    def __init__(self, jwk: dict):
+        self.jwk = jwk
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='frobo-bench-stand-ins', daemon=True)
+        self.runner = None
+
+    def start(self) -> str:
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def serve(self) -> str:
+        app = aiohttp.web.Application()
+        app.router.add_get('/discovery/keys', self.keys)
+        app.router.add_get('/auth-{token}/user/{login}/', self.intra_user)
+        app.router.add_get('/api/{version}/users/{id}', self.discord_user)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await aiohttp.web.SockSite(self.runner, sock).start()
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+    async def keys(self, request):
+        return aiohttp.web.json_response({'keys': [self.jwk]})
+
+    async def intra_user(self, request):
+        login = request.match_info['login']
+        return aiohttp.web.json_response({
+            'login': login,
+            'title': login.split('@')[0],
+            'promo': 2025,
+            'location': 'FR/PAR',
+            'course_code': 'bachelor/classic',
+            'credits': 60,
+            'gpa': [{'gpa': '3.00', 'cycle': 'bachelor'}],
+            'groups': [{'title': 'Students', 'name': 'students', 'count': 1}],
+        })
+
+    async def discord_user(self, request):
+        user_id = request.match_info['id']
+        return json_response({
+            'id': '1' if user_id == '@me' else user_id,
+            'username': 'bench',
+            'discriminator': '0000',
+            'avatar': None,
+            'bot': user_id == '@me',
+        })
+
+class Oauth(frobo.Cog):
+    '''
+    Benchmarks the account linking flow, from /epitech/verify to
+    /epitech/authorize, with Microsoft, the Epitech intra and Discord replaced
+    by local stand-ins
+    '''
+
+    dependencies = ['cli', 'config', 'discord.client', 'epitech', 'sql', 'web']
+
+    config: config.manager
+    client: discord.client
+    database: sql.database
+    ephemeral: sql.ephemeral
+    registrations: epitech.registrations
+    web: web.server
+
+    def make_key(self):
+        # Benchmarks only run on demand, spare every boot these imports
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+        jwk.update({'kid': KEY_ID, 'use': 'sig', 'alg': 'RS256'})
+        return key, jwk
+
+    def sign(self, key, index: int, nonce: str) -> str:
+        now = datetime.datetime.utcnow()
+        return jwt.encode({
+            'aud': CLIENT_ID,
+            'email': f'bench-{index}@{EMAIL_DOMAIN}',
+            'nonce': nonce,
+            'iat': now,
+            'exp': now + datetime.timedelta(hours=1),
+        }, key, algorithm='RS256', headers={'kid': KEY_ID})
+
+    def add_interactions(self, first: int, count: int):
+        for i in range(count):
+            snowflake = str(first + i)
+            self.ephemeral.put('epitech.interactions', snowflake, {'guild': '0', 'user': snowflake}, 3600)
+
+    def clean_up(self, session, first: int, count: int):
+        EpitechUser = self.registrations.EpitechUser
+        ProfileSnapshot = self.registrations.ProfileSnapshot
+        for i in range(count):
+            self.ephemeral.delete('epitech.interactions', str(first + i))
+            self.ephemeral.delete('epitech.nonces', str(first + i))
+        session.execute(
+            sqlalchemy.delete(EpitechUser).where(EpitechUser.azure.like(f'%@{EMAIL_DOMAIN}')),
+            execution_options={'synchronize_session': False},
+        )
+        session.execute(
+            sqlalchemy.delete(ProfileSnapshot).where(ProfileSnapshot.login.like(f'%@{EMAIL_DOMAIN}')),
+            execution_options={'synchronize_session': False},
+        )
+        session.commit()
+
+    async def timed(self, stats, route, request):
+        start = time.perf_counter()
+        async with request as response:
+            await response.read()
+        stats[route][0].observe(time.perf_counter() - start)
+        if response.status >= 400:
+            stats[route][1] += 1
+        return response
+
+    async def link(self, http, base, key, index, snowflake, stats):
+        response = await self.timed(
+            stats,
+            'GET /epitech/verify/{interaction}',
+            http.get(f'{base}/epitech/verify/{snowflake}', allow_redirects=False),
+        )
+        location = response.headers.get('Location', None)
+        if location is None:
+            return
+        nonce = urllib.parse.parse_qs(urllib.parse.urlsplit(location).query)['nonce'][0]
+        await self.timed(
+            stats,
+            'POST /epitech/authorize',
+            http.post(f'{base}/epitech/authorize', data={'id_token': self.sign(key, index, nonce), 'state': snowflake}),
+        )
+
+    @cli.command('bench-oauth', 'Benchmark the Epitech account linking flow (flows, concurrency) against local stand-ins', daemon=False)
+    async def bench_oauth(self, flows='200', concurrency='16'):
+        flows, concurrency = int(flows), int(concurrency)
+        key, jwk = self.make_key()
+        stand_ins = StandIns(jwk)
+        stand_in_uri = stand_ins.start()
+
+        runner = aiohttp.web.AppRunner(self.web.app, access_log=None)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await aiohttp.web.SockSite(runner, sock).start()
+        base = f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+        discord.http.Route.BASE = f'{stand_in_uri}/api/v7'
+        await self.client.client.login('bench')
+        await self.database.migrate()
+        # Far above real snowflakes of the time, so that nothing real is touched
+        first = 1 << 62
+        self.add_interactions(first, flows)
+
+        stats = collections.OrderedDict((route, [frobo.util.Histogram(), 0]) for route in (
+            'GET /epitech/verify/{interaction}',
+            'POST /epitech/authorize',
+        ))
+        indexes = iter(range(flows))
+        async def worker(http):
+            for index in indexes:
+                await self.link(http, base, key, index, str(first + index), stats)
+
+        overrides = {
+            'web.root-uri': base,
+            'epitech.azure.client-id': CLIENT_ID,
+            'epitech.azure.authority': stand_in_uri,
+            'epitech.azure.jwks-uri': f'{stand_in_uri}/discovery/keys',
+            'epitech.intra.uri': stand_in_uri,
+            'epitech.intra.token': 'bench',
+        }
+        try:
+            with self.config.override(overrides):
+                async with aiohttp.ClientSession() as http:
+                    start = time.perf_counter()
+                    await asyncio.gather(*(worker(http) for _ in range(concurrency)))
+                    elapsed = time.perf_counter() - start
+        finally:
+            # Closed from the loop's thread, which the session was opened from
+            with sqlalchemy.orm.Session(self.database.engine) as session:
+                self.clean_up(session, first, flows)
+            await self.client.client.http.close()
+            await runner.cleanup()
+            stand_ins.stop()
+
+        print(f'Linked {flows} accounts in {elapsed:.2f}s with {concurrency} concurrent flows ({flows / elapsed:.1f} flows/s)\n')
+        print_routes(stats, elapsed)
+
+NAMES = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi', 'ivan', 'judy', 'mallory', 'oscar']
+LOCATIONS = ['FR/PAR', 'FR/LYN', 'FR/BDX', 'FR/MAR', 'FR/NCY', 'BE/BRU', 'DE/BER', 'ES/BAR']
+COURSES = ['bachelor/classic', 'bachelor/tek1ed', 'master/classic', 'master/tek3si', 'premsc']
+GROUPS = ['students', 'astek', 'pedago', 'tek1', 'tek2', 'tek3', 'hub', 'cobra', 'b-innovation']
+SKILLS = ['c', 'python', 'rust', 'sql', 'devops', 'security']
+OPERATORS = '=!<>^$~%@'
+# Key paths rules are made of, with whether they lead to numbers
+KEYS = {
+    'login': False,
+    'title': False,
+    'promo': True,
+    'location': False,
+    'course_code': False,
+    'studentyear': True,
+    'credits': True,
+    'semester': True,
+    'close': True,
+    'gpa.gpa': False,
+    'gpa.cycle': False,
+    'groups.name': False,
+    'groups.title': False,
+    'groups.count': True,
+    'nsstat.active': True,
+    'nsstat.idle': True,
+    'skills.name': False,
+    'skills.levels': True,
+    'missing': False,
+    'groups.missing': False,
+}
+
+def make_profile(rng, index: int, mixed: bool=False) -> dict:
+    '''
+    Generate a profile shaped like intra /user/ payloads, with nested dicts,
+    lists of dicts and lists of lists, and some keys missing or null
+
+    Mixed profiles also put values of unexpected types at any key, which
+    the current evaluator may raise on
+    '''
+    first, last = rng.choice(NAMES), rng.choice(NAMES)
+    profile = {
+        'login': f'{first}.{last}{index}@epitech.eu',
+        'title': f'{first.title()} {last.title()}',
+        'promo': rng.randint(2018, 2028),
+        'location': rng.choice(LOCATIONS),
+        'course_code': rng.choice(COURSES),
+        'studentyear': rng.randint(1, 5),
+        'credits': rng.randint(0, 300),
+        'semester': rng.randint(0, 10),
+        'close': rng.random() < 0.05,
+        'gpa': [{'gpa': f'{rng.uniform(0, 4):.2f}', 'cycle': cycle} for cycle in ('bachelor', 'master')[:rng.randint(1, 2)]],
+        'groups': [
+            {'title': name.title(), 'name': name, 'count': rng.randint(1, 3000)}
+            for name in rng.sample(GROUPS, rng.randint(0, 4))
+        ],
+        'nsstat': {'active': round(rng.uniform(0, 60), 1), 'idle': rng.randint(0, 40)},
+        'skills': [
+            [{'name': name, 'levels': [rng.randint(0, 5) for _ in range(rng.randint(0, 3))]}]
+            for name in rng.sample(SKILLS, rng.randint(0, 3))
+        ],
+    }
+    for key in ('location', 'course_code', 'promo', 'nsstat'):
+        if rng.random() < 0.05:
+            profile[key] = None
+    for key in ('gpa', 'groups', 'semester'):
+        if rng.random() < 0.05:
+            del profile[key]
+    if mixed:
+        for key in list(profile.keys()):
+            if rng.random() < 0.1:
+                profile[key] = rng.choice([
+                    None, '', '2025', 3.5, -1, True, [], [None, 'a'], {'x': 1}, [[1, '2']],
+                    # Integers and bounds around them floats cannot represent exactly
+                    2 ** 53 + 1, -2 ** 53 - 3, float(2 ** 53),
+                ])
+    return profile
+
+def sample_values(get_profile_value, profiles: list, key: str) -> list:
+    values = []
+    for profile in profiles:
+        value = get_profile_value(profile, key)
+        stack = [value]
+        while len(stack) > 0:
+            value = stack.pop()
+            if isinstance(value, list):
+                stack.extend(value)
+            elif value is not None:
+                values.append(value)
+    return values
+
+def make_condition(rng, key: str, values: list, numeric: bool, mixed: bool=False) -> tuple[str, str]:
+    '''
+    Pick an operator and an expected value for a key, derived from values
+    found there so that conditions match some profiles but not all
+    '''
+    text = str(rng.choice(values)) if len(values) > 0 else rng.choice(NAMES)
+    numbers = [v for v in values if isinstance(v, (int, float))]
+    cond = rng.choice(OPERATORS)
+    if cond in ('<', '>'):
+        if not (numeric or mixed) or len(numbers) == 0 or rng.random() < 0.1:
+            # Bounds that are not integers never match
+            return cond, rng.choice(['abc', '1.5', ''])
+        return cond, str(int(rng.choice(numbers)) + rng.randint(-3, 3))
+    start = rng.randint(0, len(text))
+    end = rng.randint(start, len(text))
+    if cond in ('=', '!'):
+        return cond, rng.choice([text, text, 'None', text.upper()])
+    elif cond == '^':
+        return cond, text[:end]
+    elif cond == '$':
+        return cond, text[start:]
+    elif cond in ('%', '@'):
+        return cond, text[start:end]
+    return cond, rng.choice([
+        re.escape(text[:end]),
+        re.escape(text[:end]) + '.*',
+        '.*' + re.escape(text[start:]) + '$',
+        r'\d+',
+        '[a-z]+',
+        '^$',
+    ])
+
+class Rules(frobo.Cog):
+    '''
+    Benchmarks role rule evaluation on synthetic intra profiles, per member as
+    done when a single member gets updated, and per guild, both condition by
+    condition and with the columnar evaluator used by guild updates
+
+    The fuzz-rules command checks that the columnar evaluator matches exactly
+    the same profiles as the condition by condition one, on random profiles
+    and rules mixing value types, skipping the pairs the latter raises on
+    '''
+
+    dependencies = ['cli', 'discord.roles']
+
+    roles: discord.roles
+
+    def make_rules(self, rng, profiles: list, count: int, mixed: bool=False) -> list:
+        helpers = self.roles.module.module
+        keys = list(KEYS.keys())
+        samples = {key: sample_values(helpers.get_profile_value, profiles[:200], key) for key in keys}
+        rules = []
+        for i in range(count):
+            conditions = []
+            for key in rng.sample(keys, rng.randint(1, 3)):
+                cond, value = make_condition(rng, key, samples[key], KEYS[key], mixed)
+                conditions.append(helpers.CachedCondition(key, cond, value))
+            rules.append(helpers.CachedRule(i, '0', str(rng.randrange(max(count // 3, 1))), tuple(conditions)))
+        return rules
+
+    def reference(self, rules: list, profiles: list) -> list[set]:
+        return [{rule.role for rule in rules if self.roles.match(rule, profile)} for profile in profiles]
+
+    def columnar(self, rules: list, profiles: list) -> list[set]:
+        import numpy
+        roles, matrix = self.roles.match_all(rules, profiles)
+        return [{roles[j] for j in numpy.flatnonzero(row)} for row in matrix]
+
+    @cli.command('bench-rules', 'Benchmark role rule evaluation (members, rule counts separated by commas, seed) on synthetic profiles', daemon=False)
+    async def bench_rules(self, members='2000', rules='10,50,200', seed='0'):
+        members, seed = int(members), int(seed)
+        rng = random.Random(seed)
+        profiles = [make_profile(rng, i) for i in range(members)]
+
+        print(f'Evaluating rules on {members} profiles\n')
+        print(f'{"Rules":>6s} {"Conditions":>10s} {"Per member":>11s} {"Per guild":>11s} {"Columnar":>11s} {"Speedup":>8s} {"Differences":>11s}')
+        for count in map(int, rules.split(',')):
+            rule_set = self.make_rules(rng, profiles, count)
+            start = time.perf_counter()
+            expected = self.reference(rule_set, profiles)
+            reference = time.perf_counter() - start
+            start = time.perf_counter()
+            found = self.columnar(rule_set, profiles)
+            columnar = time.perf_counter() - start
+
+            differences = sum(1 for a, b in zip(expected, found) if a != b)
+            conditions = sum(len(rule.conditions) for rule in rule_set)
+            print(
+                f'{count:6d} {conditions:10d} {reference / members * 1e6:9.1f}us {reference * 1000:9.1f}ms'
+                f' {columnar * 1000:9.1f}ms {reference / columnar:7.1f}x {differences:11d}'
+            )
+
+    @cli.command('fuzz-rules', 'Check that guild-wide rule evaluation matches member by member evaluation (rounds, seed)', daemon=False)
+    async def fuzz_rules(self, rounds='200', seed='0'):
+        rounds, seed = int(rounds), int(seed)
+        compared = skipped = 0
+        mismatches = []
+        for index in range(rounds):
+            rng = random.Random(seed + index)
+            profiles = [make_profile(rng, i, mixed=True) for i in range(rng.randint(1, 150))]
+            # One role per rule, to compare rules rather than their union
+            rule_set = [
+                dataclasses.replace(rule, role=str(rule.id))
+                for rule in self.make_rules(rng, profiles, rng.randint(1, 30), mixed=True)
+            ]
+            roles, matrix = self.roles.match_all(rule_set, profiles)
+            columns = {role: j for j, role in enumerate(roles)}
+            for rule in rule_set:
+                for i, profile in enumerate(profiles):
+                    try:
+                        expected = self.roles.match(rule, profile)
+                    except TypeError:
+                        # Ordering values that are not numbers
+                        skipped += 1
+                        continue
+                    compared += 1
+                    if bool(matrix[i, columns[rule.role]]) != expected:
+                        mismatches.append((seed + index, rule, profile, expected))
+            # Let the loop breathe between rounds
+            await asyncio.sleep(0)
+
+        print(f'Compared {compared} rule and profile pairs over {rounds} rounds, skipped {skipped} the reference raised on')
+        if len(mismatches) == 0:
+            print('No differences found')
+            return
+        helpers = self.roles.module.module
+        print(f'\033[91;1m{len(mismatches)} differences found\033[0m')
+        for case, rule, profile, expected in mismatches[:10]:
+            print(f'\nSeed {case}, expected {expected}')
+            for condition in rule.conditions:
+                value = repr(helpers.get_profile_value(profile, condition.key))
+                print(f'    {condition.key} {condition.cond} {condition.value!r}: {value[:100]}')
+        self.core.exit(1)
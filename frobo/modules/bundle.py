@@ -0,0 +1,60 @@
+import datetime
+import frobo
+import importlib.util
+import json
+import marshal
+import os
+import zipfile
+from pathlib import Path
+
+def timestamp_pyc(code, mtime: float, size: int) -> bytes:
+    '''
+    Serialize a code object the way timestamp-based .pyc files are written
+    '''
+    return b''.join([
+        importlib.util.MAGIC_NUMBER,
+        (0).to_bytes(4, 'little'),
+        (int(mtime) & 0xFFFFFFFF).to_bytes(4, 'little'),
+        (size & 0xFFFFFFFF).to_bytes(4, 'little'),
+        marshal.dumps(code),
+    ])
+
+class Builder(frobo.Cog):
+    dependencies = ['cli']
+
+    def add_module(self, archive: zipfile.ZipFile, path: Path, name: tuple[str, ...]) -> str:
+        package = path.name == '__init__.py'
+        target = Path(*name, '__init__.pyc') if package else Path(*name[:-1], f'{name[-1]}.pyc')
+        stat = path.stat()
+        code = compile(path.read_bytes(), str(path), 'exec', dont_inherit=True)
+        archive.writestr(target.as_posix(), timestamp_pyc(code, stat.st_mtime, stat.st_size))
+
+        if package:
+            # Packages may ship data files, read through their __loader__
+            for directory, _, files in os.walk(path.parent):
+                directory = Path(directory)
+                if directory.name == '__pycache__':
+                    continue
+                for file in files:
+                    source = directory / file
+                    if source == path or source.suffix == '.pyc':
+                        continue
+                    archive.write(source, (Path(*name) / source.relative_to(path.parent)).as_posix())
+        return target.as_posix()
+
+    @cli.command('bundle', 'Package modules as precompiled bytecode in a single archive', daemon=False)
+    async def bundle(self, output='frobo.bundle'):
+        modules = []
+        seen = set()
+        with zipfile.ZipFile(output, 'w') as archive:
+            for base, path, name in self.core.discover_modules():
+                # Like when indexing, the first module found for a name wins
+                if base.is_file() or name in seen:
+                    continue
+                seen.add(name)
+                modules.append({'name': list(name), 'path': self.add_module(archive, path, name)})
+            archive.writestr('manifest.json', json.dumps({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'modules': modules,
+            }, indent=4))
+        print(f'Bundled {len(modules)} modules into {output}')
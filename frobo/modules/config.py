@@ -1,33 +1,174 @@
+import asyncio
+import contextlib
+import dataclasses
 import frobo
-import functools
-import toml
 import os
+import toml
+import types
+from typing import Any, Mapping, Optional
+
+TRUE_STRINGS = {'1', 'true', 'yes', 'on'}
+FALSE_STRINGS = {'0', 'false', 'no', 'off', ''}
+
+def flatten(values: dict, prefix: tuple[str, ...]=()) -> dict[str, Any]:
+    '''
+    Flatten nested tables to dotted keys, keeping the tables themselves
+    reachable under their own key
+    '''
+    flat = {}
+    for key, value in values.items():
+        path = (*prefix, key)
+        flat['.'.join(path)] = value
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+    return flat
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    '''
+    An immutable view of the configuration at a given time
+
+    Values from the configuration file take precedence over FROBO_* variables
+    from the environment, which are only consulted for missing keys
+    '''
+
+    values:  Mapping[str, Any]
+    environ: Mapping[str, str]
+    mtime:   Optional[float]=None
+
+    def get(self, key: str, default=None):
+        try:
+            return self.values[key]
+        except KeyError:
+            return self.environ.get('FROBO_' + key.upper().replace('.', '_'), default)
+
+    def get_int(self, key: str, default: Optional[int]=None) -> Optional[int]:
+        value = self.get(key, None)
+        return default if value is None else int(value)
+
+    def get_float(self, key: str, default: Optional[float]=None) -> Optional[float]:
+        value = self.get(key, None)
+        return default if value is None else float(value)
+
+    def get_bool(self, key: str, default: bool=False) -> bool:
+        value = self.get(key, None)
+        if value is None:
+            return default
+        if isinstance(value, str):
+            normalized = value.strip().lower()
+            if normalized in TRUE_STRINGS:
+                return True
+            if normalized in FALSE_STRINGS:
+                return False
+            raise ValueError(f'Invalid boolean for {key}: {value}')
+        return bool(value)
+
+    def get_list(self, key: str, default: Optional[list]=None) -> list:
+        value = self.get(key, None)
+        if value is None:
+            return list(default or [])
+        if isinstance(value, str):
+            return [v.strip() for v in value.split(',') if v.strip() != '']
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
 
 class Manager(frobo.Cog):
+    '''
+    Loads frobo.toml into a snapshot, swapped whenever the file changes
+
+    Events:
+        config.reloaded: Fired with the new snapshot after the configuration
+        file changed on disk
+    '''
+
     features = frobo.CogFeature.INJECTABLE
 
     def get(self, key: frobo.util.Key, default=None):
-        if isinstance(key, str):
-            key = key.split('.')
-        # TODO: Improve with array handling and such
-        loaded = self._loaded
-        for entry in key:
-            loaded = loaded.get(entry, None)
-            if not isinstance(loaded, dict):
-                break
-        if loaded is None:
-            return os.getenv('FROBO_' + '_'.join(map(str.upper, key)), default)
-        return loaded
+        if not isinstance(key, str):
+            key = '.'.join(key)
+        return self.snapshot.get(key, default)
 
-    @core.event('core.mount')
-    async def on_mount(self):
-        self._loaded = {}
+    def get_int(self, key: str, default: Optional[int]=None) -> Optional[int]:
+        return self.snapshot.get_int(key, default)
+
+    def get_float(self, key: str, default: Optional[float]=None) -> Optional[float]:
+        return self.snapshot.get_float(key, default)
+
+    def get_bool(self, key: str, default: bool=False) -> bool:
+        return self.snapshot.get_bool(key, default)
+
+    def get_list(self, key: str, default: Optional[list]=None) -> list:
+        return self.snapshot.get_list(key, default)
+
+    @contextlib.contextmanager
+    def override(self, values: Mapping[str, Any]):
+        '''
+        Temporarily take the given dotted keys over the current configuration,
+        letting tools point cogs at other services
+        '''
+        previous = self.snapshot
+        self.snapshot = dataclasses.replace(previous, values=types.MappingProxyType({**previous.values, **values}))
         try:
-            with open(self.get('config.path', 'frobo.toml')) as f:
-                self._loaded = toml.load(f)
+            yield self.snapshot
+        finally:
+            self.snapshot = previous
+
+    def load(self) -> Snapshot:
+        '''
+        Build a new snapshot from the configuration file and the environment
+        '''
+        environ = {k: v for k, v in os.environ.items() if k.startswith('FROBO_')}
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path) as f:
+                values = toml.load(f)
         except FileNotFoundError:
-            pass
+            mtime, values = None, {}
+        return Snapshot(types.MappingProxyType(flatten(values)), types.MappingProxyType(environ), mtime)
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self.seen:
+                continue
+            self.seen = mtime
+            try:
+                snapshot = self.load()
+            except (OSError, toml.TomlDecodeError) as e:
+                print(f'\033[91;1mCould not reload {self.path}: {e}\033[0m')
+                continue
+            self.snapshot = snapshot
+            self.core.unmount_timeout = self.get_float('core.unmount-timeout', self.core.unmount_timeout)
+            # A failing handler must not stop the watcher for good
+            try:
+                await self.core.emit('config.reloaded', snapshot)
+            except Exception as e:
+                print(f'\033[91;1mCould not apply the reloaded {self.path}: {e!r}\033[0m')
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.snapshot = Snapshot({}, types.MappingProxyType(dict(os.environ)))
+        self.path = self.get('config.path', 'frobo.toml')
+        self.snapshot = self.load()
+        self.seen = self.snapshot.mtime
+        # Cogs mounted before this one got the timeout given to the core, which
+        # manage.py reads from the same file
+        self.core.unmount_timeout = self.get_float('core.unmount-timeout', self.core.unmount_timeout)
+        self.watcher = None
+        interval = self.get_float('config.reload-interval', 2.0)
+        if interval > 0:
+            self.watcher = self.core.loop.create_task(self.watch(interval))
+
+    @core.event('core.unmount')
+    async def on_unmount(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
 
     @core.injectable('config.value')
     def value(self, key: str, default=None):
-        return self.get(key, default)
\ No newline at end of file
+        return self.get(key, default)
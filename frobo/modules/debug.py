@@ -0,0 +1,212 @@
+import aiohttp.web
+import collections
+import frobo
+import gc
+import hmac
+import signal
+import tracemalloc
+import types
+import weakref
+
+OUTSIDE = '<outside modules>'
+
+def format_size(size: int, signed: bool=False) -> str:
+    sign = '+' if signed and size > 0 else ''
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f'{sign}{size:.0f} {unit}' if unit == 'B' else f'{sign}{size:.1f} {unit}'
+        size /= 1024
+    return f'{sign}{size:.1f} GiB'
+
+def referrers(obj) -> list:
+    # Frames of the report itself refer to everything it looks at
+    return [r for r in gc.get_referrers(obj) if not isinstance(r, types.FrameType)]
+
+class Memory(frobo.Cog):
+    '''
+    Attributes traced memory allocations to the modules and cogs making them,
+    comparing each report to the previous one and to the first one, and lists
+    the kernel structures that keep objects alive, like cached registration
+    wrappers and modules or cogs that are still referenced after being unloaded
+
+    Allocations are traced when started through the profile command, or from
+    mount when debug.memory.trace is set. Reports are printed on SIGUSR1, and
+    served on /debug/memory to requests bearing debug.token
+
+    The reload-check command reloads a module repeatedly, then reports whether
+    its previous versions could be garbage collected and how traced memory
+    grew along the way
+    '''
+
+    dependencies = ['cli', 'config', 'web']
+
+    cli: cli.parser
+    config: config.manager
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.baseline = None
+        self.previous = None
+        self.retired = []
+        self.retired_cogs = []
+        self.started = False
+        if self.config.get_bool('debug.memory.trace', False):
+            self.trace()
+        self.core.loop.add_signal_handler(signal.SIGUSR1, self.on_signal)
+
+    @core.event('core.unmount')
+    async def on_unmount(self):
+        self.core.loop.remove_signal_handler(signal.SIGUSR1)
+        if self.started:
+            tracemalloc.stop()
+
+    @core.event('core.unmounting')
+    async def on_unmounting(self, cog):
+        # Modules are forgotten by the core on reload, but may be kept alive
+        module = cog.module.module
+        if not any(ref() is module for _, ref in self.retired):
+            self.retired.append((cog.module.name, weakref.ref(module)))
+        self.retired_cogs.append((cog.qualname, weakref.ref(cog)))
+
+    def trace(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.config.get_int('debug.memory.frames', 16))
+            self.started = True
+
+    def on_signal(self):
+        print(self.report())
+
+    def attribute(self, snapshot) -> dict[str, list[int]]:
+        '''
+        Sum the size and count of traced blocks by the cog, or module, of the
+        most recent frame of their traceback found in a module
+        '''
+        located = {}
+        owners = collections.defaultdict(lambda: [0, 0])
+        for trace in snapshot.traces:
+            owner = None
+            for frame in reversed(trace.traceback):
+                key = (frame.filename, frame.lineno)
+                if key not in located:
+                    located[key] = self.core.locate(*key)
+                owner = located[key]
+                if owner is not None:
+                    break
+            entry = owners['.'.join(owner) if owner is not None else OUTSIDE]
+            entry[0] += trace.size
+            entry[1] += 1
+        return dict(owners)
+
+    def report_allocations(self, limit: int) -> list[str]:
+        if not tracemalloc.is_tracing():
+            return ['Allocations are not traced, use the profile command or set debug.memory.trace']
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        owners = self.attribute(snapshot)
+        previous, self.previous = self.previous or owners, owners
+        if self.baseline is None:
+            self.baseline = owners
+
+        lines = [f'{"Owner":40s} {"Size":>11s} {"Blocks":>9s} {"Since last":>12s} {"Since first":>12s}']
+        for owner, (size, count) in sorted(owners.items(), key=lambda item: -item[1][0])[:limit]:
+            last = size - previous.get(owner, (0, 0))[0]
+            first = size - self.baseline.get(owner, (0, 0))[0]
+            lines.append(
+                f'{owner[:40]:40s} {format_size(size):>11s} {count:9d}'
+                f' {format_size(last, True):>12s} {format_size(first, True):>12s}'
+            )
+        traced, peak = tracemalloc.get_traced_memory()
+        lines.append(f'\nTraced {format_size(traced)}, peaked at {format_size(peak)}')
+        return lines
+
+    def leftovers(self) -> tuple[list, list]:
+        '''
+        Collect garbage, then return the names and weak references of the
+        unloaded modules and unmounted cogs that are still referenced
+        '''
+        gc.collect()
+        self.retired = [(name, ref) for name, ref in self.retired if ref() is not None]
+        self.retired_cogs = [(name, ref) for name, ref in self.retired_cogs if ref() is not None]
+        modules = [
+            (name, ref) for name, ref in self.retired
+            if name not in self.core.modules or self.core.modules[name].module is not ref()
+        ]
+        cogs = [(name, ref) for name, ref in self.retired_cogs if self.core.cogs.get(name, None) is not ref()]
+        return modules, cogs
+
+    def report_kernel(self, limit: int) -> list[str]:
+        wrappers = {}
+        resolved = {}
+        for qualname, cog in self.core.cogs.items():
+            name = '.'.join(qualname)
+            wrappers[name] = len(vars(cog).get('__wrappers__', {}))
+            resolved[name] = len(vars(cog).get('__resolved__', {}))
+
+        alive, cogs = self.leftovers()
+
+        lines = [
+            f'{len(self.core.cogs)} cogs mounted from {len(self.core.modules)} modules',
+            f'{sum(wrappers.values())} cached registration wrappers, {sum(resolved.values())} cached cog attributes',
+        ]
+        for name, count in sorted(wrappers.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f'    {name[:40]:40s} {count:5d} wrappers {resolved[name]:5d} attributes')
+        return [*lines, *self.report_leftovers(alive, cogs)]
+
+    def report_leftovers(self, modules: list, cogs: list) -> list[str]:
+        lines = [f'{len(modules)} modules still referenced after being unloaded']
+        for name, ref in modules:
+            lines.append(f'    {".".join(name)} ({len(referrers(ref()))} referrers)')
+        lines.append(f'{len(cogs)} cogs still referenced after being unmounted')
+        for name, ref in cogs:
+            counts = collections.Counter(type(r).__name__ for r in referrers(ref()))
+            lines.append(f'    {".".join(name)} (referred to by {", ".join(f"{n} {t}" for t, n in counts.most_common())})')
+        return lines
+
+    def report(self, limit: int=20) -> str:
+        return '\n'.join([
+            'Allocations by owner',
+            *self.report_allocations(limit),
+            '',
+            'Kernel structures',
+            *self.report_kernel(limit),
+        ])
+
+    @web.route('GET', '/debug/memory')
+    async def serve_report(self, request):
+        token = self.config.get('debug.token')
+        authorization = request.headers.get('Authorization', '')
+        # Hide the route altogether unless authorized
+        if token is None or not hmac.compare_digest(authorization, f'Bearer {token}'):
+            raise aiohttp.web.HTTPNotFound()
+        try:
+            limit = int(request.query.get('limit', 20))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text='limit must be an integer')
+        if limit < 0:
+            raise aiohttp.web.HTTPBadRequest(text='limit must not be negative')
+        return aiohttp.web.Response(text=self.report(limit))
+
+    @cli.command('profile', 'Start with memory allocations traced, reporting them on SIGUSR1')
+    async def profile(self, *args):
+        self.trace()
+        await self.cli.run('start', *args, should_exit=False, terse=True)
+
+    @cli.command('reload-check', 'Reload a module (name, times) repeatedly and report what its previous versions leave behind', daemon=False)
+    async def reload_check(self, name, times='10'):
+        name = tuple(name.split('.'))
+        if any(name == dep[:len(name)] for dep in (*self.dependencies, self.qualname)):
+            print(f'\033[91;1mCannot reload {".".join(name)}, which this check depends on\033[0m')
+            return
+        self.trace()
+        await self.core.load_module(name=name)
+        sizes = []
+        for _ in range(int(times)):
+            await self.core.reload_module(name=name)
+            gc.collect()
+            sizes.append(tracemalloc.get_traced_memory()[0])
+
+        modules, cogs = self.leftovers()
+        print(f'Reloaded {".".join(name)} {len(sizes)} times')
+        if len(sizes) > 1:
+            growth = (sizes[-1] - sizes[0]) / (len(sizes) - 1)
+            print(f'Traced memory went from {format_size(sizes[0])} to {format_size(sizes[-1])}, {format_size(growth, True)} per reload')
+        print('\n'.join(self.report_leftovers(modules, cogs)))
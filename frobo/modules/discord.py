@@ -1,11 +1,20 @@
+import asyncio
+import collections
+import contextvars
+import dataclasses
 import discord
 import discord_slash, discord_slash.cog_ext
 import frobo
 import functools
+import hashlib
 import itertools
+import json
+import math
 import re
 import sqlalchemy, sqlalchemy.orm
+import time
 from discord_slash.utils.manage_commands import create_option, get_all_commands
+from typing import Optional
 
 def get_profile_value(profile, key):
     if isinstance(key, str):
@@ -67,13 +76,119 @@ def do_test(real_value, condition, expected_value):
     elif condition == '@':
         return expected_value not in str(real_value) 
 
-def find_by(permissions, pred, default=None):
-    for perm in permissions:
-        if pred(perm):
-            return perm
-    if default is not None:
-        permissions.append(default)
-    return default
+# Integers past this one may not be represented exactly as floats
+FLOAT_EXACT = 2 ** 53
+
+def flatten_values(value):
+    if isinstance(value, list):
+        for item in value:
+            yield from flatten_values(item)
+    else:
+        yield value
+
+class ProfileColumn:
+    '''
+    The values found at one key path of a set of profiles, flattened into
+    arrays along with the index of the profile each of them comes from, to
+    test conditions on all profiles at once with the same results as do_test
+
+    Numbers are compared as floats, except integers too large for that to be
+    exact, which are compared one by one like do_test does
+    '''
+
+    def __init__(self, profiles, key):
+        # Only needed by rules, which not every command evaluates
+        import numpy
+        owners = []
+        values = []
+        for i, profile in enumerate(profiles):
+            for value in flatten_values(get_profile_value(profile, key)):
+                owners.append(i)
+                values.append(value)
+        self.count = len(profiles)
+        self.values = values
+        self.owners = numpy.array(owners, dtype=numpy.intp)
+        self.present = numpy.array([v is not None for v in values], dtype=bool)
+        self.strings = numpy.array([str(v) for v in values], dtype=str)
+        # Values that are not numbers are NaN, which compares as false
+        self.numbers = numpy.full(len(values), numpy.nan)
+        self.numeric = []
+        self.inexact = []
+        for i, value in enumerate(values):
+            if not isinstance(value, (int, float)):
+                continue
+            self.numeric.append(i)
+            if isinstance(value, int) and abs(value) > FLOAT_EXACT:
+                self.inexact.append(i)
+            else:
+                self.numbers[i] = value
+
+    def mask(self, condition, expected):
+        import numpy
+        if condition == '=':
+            return self.strings == expected
+        elif condition == '!':
+            return self.strings != expected
+        elif condition in ('<', '>'):
+            try:
+                bound = int(expected)
+            except ValueError:
+                return numpy.zeros(len(self.strings), dtype=bool)
+            with numpy.errstate(invalid='ignore'):
+                compared = self.numbers <= bound if condition == '<' else self.numbers >= bound
+            # Compare the values floats cannot, or all of them when the bound
+            # itself cannot be one exactly
+            for i in self.numeric if abs(bound) > FLOAT_EXACT else self.inexact:
+                value = self.values[i]
+                compared[i] = value <= bound if condition == '<' else value >= bound
+            return self.present & compared
+        elif condition == '^':
+            return self.present & numpy.char.startswith(self.strings, expected)
+        elif condition == '$':
+            return self.present & numpy.char.endswith(self.strings, expected)
+        elif condition == '~':
+            # Run the expression once per distinct value
+            distinct, inverse = numpy.unique(self.strings, return_inverse=True)
+            matched = numpy.array([re.match(expected, value) is not None for value in distinct], dtype=bool)
+            return self.present & matched[inverse.reshape(-1)]
+        elif condition == '%':
+            return self.present & (numpy.char.find(self.strings, expected) >= 0)
+        elif condition == '@':
+            return self.present & (numpy.char.find(self.strings, expected) < 0)
+        return numpy.zeros(len(self.strings), dtype=bool)
+
+    def test(self, condition, expected):
+        '''
+        Return which profiles have any value meeting a condition
+        '''
+        import numpy
+        mask = self.mask(condition, expected)
+        return numpy.bincount(self.owners[mask], minlength=self.count) > 0
+
+def index_permissions(permissions):
+    return {
+        perm['id']: {str(target['id']): dict(target) for target in perm['permissions']}
+        for perm in permissions
+    }
+
+def flatten_permissions(index):
+    return [
+        {'id': command_id, 'permissions': list(targets.values())}
+        for command_id, targets in index.items()
+    ]
+
+def set_permission(index, commands, target_id, target_type, permission):
+    updated = False
+    for command_id in commands:
+        targets = index.setdefault(command_id, {})
+        target = targets.get(target_id, None)
+        if target is None:
+            targets[target_id] = {'id': target_id, 'type': target_type, 'permission': permission}
+            updated = True
+        elif target['permission'] != permission:
+            target['permission'] = permission
+            updated = True
+    return updated
 
 
 def partition(fn, iterable):
@@ -88,89 +203,498 @@ def partition(fn, iterable):
 
     return unmatched, matched
 
-class HookedClient(discord.Client):
+@dataclasses.dataclass(frozen=True)
+class CachedCondition:
+    key:   str
+    cond:  str
+    value: str
+
+@dataclasses.dataclass(frozen=True)
+class CachedRule:
+    id:         int
+    guild:      str
+    role:       str
+    conditions: tuple[CachedCondition, ...]
+
+    @classmethod
+    def from_model(cls, rule):
+        conditions = tuple(CachedCondition(c.key, c.cond, c.value) for c in rule.conditions)
+        return cls(rule.id, str(rule.guild), str(rule.role), conditions)
+
+    def sort_key(self):
+        return (self.role, self.id)
+
+def command_digest(command):
+    encoded = json.dumps(command, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def route_key(*name):
+    if len(name) > 2:
+        return tuple(name[:3])
+    return (name[0], None, name[1] if len(name) > 1 else None)
+
+def parse_interaction(interaction):
+    '''
+    Split the data of a command interaction into the route key of the command
+    and the options passed to it
+    '''
+    name = [interaction['name']]
+    options, grpname = partition(lambda o: o['type'] in (1, 2), interaction.get('options', []))
+    if len(grpname) > 0:
+        name.append(grpname[0]['name'])
+        grpoptions, subname = partition(lambda o: o['type'] in (1, 2), grpname[0].get('options', []))
+        options.extend(grpoptions)
+        if len(subname) > 0:
+            name.append(subname[0]['name'])
+            options.extend(subname[0].get('options', []))
+    return route_key(*name), options
+
+def payload_guild(msg):
+    data = msg.get('d', None)
+    if not isinstance(data, dict):
+        return None
+    if 'guild_id' not in data and (msg.get('t') or '').startswith('GUILD_'):
+        return data.get('id', None)
+    return data.get('guild_id', None)
+
+def event_guild(args):
+    for arg in args:
+        if isinstance(arg, discord.Guild):
+            return arg.id
+        guild = getattr(arg, 'guild', None)
+        if isinstance(guild, discord.Guild):
+            return guild.id
+        guild_id = getattr(arg, 'guild_id', None)
+        if guild_id is not None:
+            return guild_id
+    return None
+
+class Hooks:
+    # When set, collects the event tasks scheduled in the current context
+    tracked = contextvars.ContextVar('tracked', default=None)
+
     def __init__(self, cog, *args, debug_guild=None, **kwargs):
-        discord.Client.__init__(self, *args, **kwargs)
-        self.interactions = discord_slash.client.SlashCommand(self, debug_guild=debug_guild, sync_commands=True)
+        super().__init__(*args, **kwargs)
+        self.interactions = discord_slash.client.SlashCommand(self, debug_guild=debug_guild, sync_commands=False)
         del self.on_socket_response
         self.cog = cog
 
+    def shard_of(self, guild_id) -> Optional[int]:
+        '''
+        Find the shard receiving the events of a guild, the way Discord
+        distributes guilds among shards
+        '''
+        if guild_id is None:
+            return None
+        return (int(guild_id) >> 22) % (self.shard_count or 1)
+
     async def on_socket_response(self, msg):
-        await self.interactions.on_socket_response(msg)
-        await self.cog.core.emit('discord.socket_response', msg)
+        # discord_slash does not know about autocompletion and raises on it
+        if msg['t'] != 'INTERACTION_CREATE' or msg['d']['type'] != 4:
+            await self.interactions.on_socket_response(msg)
+        await self.cog.core.emit(
+            'discord.socket_response',
+            msg,
+            context_injectables={'discord.shard': self.shard_of(payload_guild(msg))},
+        )
+
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        task = super()._schedule_event(coro, event_name, *args, **kwargs)
+        tracked = self.tracked.get()
+        if tracked is not None:
+            tracked.append(task)
+        return task
 
 
     def __getattr__(self, key: str):
         if key.startswith('on_'):
             async def fn(*args, **kwargs):
-                await self.cog.core.emit(f'discord.{key[3:]}', *args, handler_kwargs=kwargs)
+                event = key[3:]
+                # Shard events are given the shard they are about first
+                shard = args[0] if event.startswith('shard_') else self.shard_of(event_guild(args))
+                await self.cog.core.emit(
+                    f'discord.{event}',
+                    *args,
+                    handler_kwargs=kwargs,
+                    context_injectables={'discord.shard': shard},
+                )
             return fn
         raise AttributeError(key)
 
+class HookedClient(Hooks, discord.Client):
+    pass
+
+class HookedShardedClient(Hooks, discord.AutoShardedClient):
+    pass
+
 class Client(frobo.Cog):
-    dependencies = ['cli', 'config']
+    '''
+    Connects to Discord and routes slash commands to the cogs registering them
+
+    Options declared with autocomplete set are completed by the
+    discord.autocomplete registration for the same command and option name,
+    which gets the partial value and returns up to 25 choices
+
+    The gateway is connected through a single connection by default. Setting
+    discord.shards to "auto" lets Discord pick a shard count, all connected
+    from this process, while a number of shards along with discord.shard-ids
+    spreads them across processes, each connecting the listed ones
+
+    Handlers of Discord events can be given the shard the event was received
+    on by annotating a parameter with discord.shard, None for events that do
+    not concern a guild
+
+    Events:
+        discord.commands_synced: Fired after slash commands were synchronized
+        with Discord, with whether they changed, in every process when shards
+        are spread across several of them
+    '''
+
+    dependencies = ['cli', 'config', 'sql']
     features = frobo.CogFeature.INJECTABLE
 
-    config: config.manager
+    config:   config.manager
+    database: sql.database
+
+    @sql.model('discord_commands')
+    class CommandHash:
+        scope : sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        name  : sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        id    : sqlalchemy.Column(sqlalchemy.String)
+        digest: sqlalchemy.Column(sqlalchemy.String)
 
     @core.event('core.mount')
     async def on_mount(self):
         intents = discord.Intents.default()
         intents.members = True
-        self.client = HookedClient(
-            self,
+        chunking = self.config.get('discord.members.chunk', 'startup')
+        caching = self.config.get('discord.members.cache', 'all')
+        if chunking not in ('startup', 'lazy'):
+            raise ValueError(f'Invalid member chunking policy: {chunking}')
+        if caching not in ('all', 'rules'):
+            raise ValueError(f'Invalid member caching policy: {caching}')
+        self.cache_all = caching == 'all'
+        if self.cache_all:
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+        else:
+            member_cache_flags = discord.MemberCacheFlags.none()
+        options = dict(
             loop=self.core.loop,
             debug_guild=self.config.get('discord.debug-guild'),
             intents=intents,
+            # Chunking without caching would only download members to drop them
+            chunk_guilds_at_startup=chunking == 'startup' and self.cache_all,
+            member_cache_flags=member_cache_flags,
         )
+        shards = self.config.get('discord.shards')
+        shard_ids = [int(i) for i in self.config.get_list('discord.shard-ids')]
+        if shards is None:
+            if len(shard_ids) > 0:
+                raise ValueError('discord.shard-ids requires discord.shards to be a shard count')
+            self.client = HookedClient(self, **options)
+        elif shards == 'auto':
+            if len(shard_ids) > 0:
+                raise ValueError('discord.shard-ids requires discord.shards to be a shard count')
+            self.client = HookedShardedClient(self, **options)
+        else:
+            count = int(shards)
+            if any(i < 0 or i >= count for i in shard_ids):
+                raise ValueError(f'Invalid shard IDs for {count} shards: {shard_ids}')
+            self.client = HookedShardedClient(self, shard_count=count, shard_ids=shard_ids or None, **options)
+        # Maps (command, group, subcommand) keys to their command objects
+        self.routes = {}
+        # Maps (route key, option name) to their autocompletion handlers
+        self.completions = {}
+        self.sync_lock = asyncio.Lock()
+        self.sync_handle = None
+        # Maps (guild ID, user ID) to when to query again users who were not
+        # members, so that looking them up does not hit the gateway every time
+        self.missing = {}
+        self.missing_ttl = self.config.get_float('discord.members.miss-ttl', 300.0)
+        # Delay before retrying a failed synchronization, doubled on each failure
+        self.sync_backoff = 1.0
+        # Command digests by (scope, name) last seen pushed by the primary process
+        self.known_commands = None
 
     @core.event('core.unmount')
     async def on_unmount(self):
+        if self.sync_handle is not None:
+            self.sync_handle.cancel()
         await self.client.close()
 
     @core.event('core.mounted')
     async def on_mounted(self, cog):
-        functions = [r.wrapped for r in self.core.registered('discord.command', only=[cog.qualname])]
+        registrations = list(self.core.registered('discord.command', only=[cog.qualname]))
+        functions = [r.wrapped for r in registrations]
         for fn in functions:
             fn.cog = cog
         self.client.interactions._get_cog_slash_commands(cog, functions)
         self.client.interactions._get_cog_component_callbacks(cog, functions)
 
+        routes = dict(self.routes)
+        for reg in registrations:
+            routes[route_key(*reg.args)] = reg.wrapped
+        self.routes = routes
+        for reg in self.core.registered('discord.autocomplete', only=[cog.qualname]):
+            self.completions[(route_key(*reg.args[:-1]), reg.args[-1])] = reg.wrapped
+        if len(registrations) > 0:
+            self.schedule_sync()
+
     @core.event('core.unmounting')
     async def on_unmounting(self, cog):
         self.client.interactions.remove_cog_commands(cog)
+        for reg in self.core.registered('discord.autocomplete', only=[cog.qualname]):
+            self.completions.pop((route_key(*reg.args[:-1]), reg.args[-1]), None)
+        routes = {key: fn for key, fn in self.routes.items() if fn.cog is not cog}
+        if len(routes) != len(self.routes):
+            self.schedule_sync()
+        self.routes = routes
+
+    @core.event('discord.ready')
+    async def on_ready(self):
+        self.schedule_sync(0)
+
+    def latencies(self) -> list[tuple[int, float]]:
+        '''
+        Return the heartbeat latency, in seconds, of each shard connected from
+        this process
+        '''
+        if isinstance(self.client, discord.AutoShardedClient):
+            return sorted(self.client.latencies)
+        return [(self.client.shard_id or 0, self.client.latency)]
+
+    def is_primary(self) -> bool:
+        '''
+        Whether this process connects the first shard, which is the one pushing
+        slash commands to Discord and running jobs that concern the whole bot
+        when shards are spread across processes
+        '''
+        shard_ids = getattr(self.client, 'shard_ids', None)
+        return shard_ids is None or 0 in shard_ids
+
+    def schedule_sync(self, delay=1.0):
+        '''
+        Synchronize slash commands after a delay, postponed by further calls so
+        that reloading several cogs only leads to one synchronization
+        '''
+        if not self.client.is_ready():
+            # Commands will be synchronized once ready
+            return
+        if self.sync_handle is not None:
+            self.sync_handle.cancel()
+        self.sync_handle = self.core.loop.call_later(
+            delay,
+            lambda: self.core.loop.create_task(self.resync()),
+        )
+
+    async def resync(self):
+        '''
+        Synchronize slash commands in a session of its own, retrying later with
+        an increasing delay if Discord could not be reached
+
+        Other processes wait for the primary one to push the same commands, so
+        that each of them fires discord.commands_synced for its own guilds
+        '''
+        self.sync_handle = None
+        try:
+            async with self.sync_lock:
+                with sqlalchemy.orm.Session(self.database.engine) as session:
+                    if self.is_primary():
+                        changed = await self.sync_commands(session)
+                    else:
+                        changed = await self.check_commands(session)
+        except Exception as e:
+            delay, self.sync_backoff = self.sync_backoff, min(self.sync_backoff * 2, 300.0)
+            print(f'\033[91;1mCould not synchronize slash commands, retrying in {delay:.0f}s: {e}\033[0m')
+            if self.sync_handle is None:
+                self.schedule_sync(delay)
+            return
+        self.sync_backoff = 1.0
+        await self.core.emit('discord.commands_synced', changed)
+
+    async def sync_commands(self, session) -> bool:
+        '''
+        Push the slash commands whose definition changed since the last sync to
+        Discord and delete the ones that disappeared, comparing the hashes of
+        their definitions to the ones stored after the previous sync
+
+        Scopes with no stored hashes are overwritten as a whole, returns whether
+        anything was sent to Discord
+        '''
+        interactions = self.client.interactions
+        scopes = await self.desired_commands()
+        stored = {}
+        for (row,) in session.execute(sqlalchemy.select(self.CommandHash)):
+            stored.setdefault(row.scope, {})[row.name] = row
+
+        changed = False
+        for scope in set(scopes.keys()) | set(stored.keys()):
+            desired = scopes.get(scope, {})
+            rows = stored.get(scope, {})
+            guild_id = scope or None
+            if len(rows) == 0:
+                if len(desired) == 0:
+                    continue
+                # We know nothing about what Discord has, overwrite all of it
+                created = await interactions.req.put_slash_commands(list(desired.values()), guild_id)
+                for data in created:
+                    session.add(self.CommandHash(
+                        scope=scope,
+                        name=data['name'],
+                        id=str(data['id']),
+                        digest=command_digest(desired[data['name']]),
+                    ))
+                changed = True
+            else:
+                for name, command in desired.items():
+                    digest = command_digest(command)
+                    row = rows.get(name, None)
+                    if row is not None and row.digest == digest:
+                        continue
+                    # Creating a command overwrites the existing one with the same name
+                    data = await interactions.req.command_request('POST', guild_id, json=command)
+                    if row is None:
+                        row = self.CommandHash(scope=scope, name=name)
+                        session.add(row)
+                    row.id, row.digest = str(data['id']), digest
+                    changed = True
+                for name, row in rows.items():
+                    if name not in desired:
+                        await interactions.req.remove_slash_command(guild_id, row.id)
+                        session.delete(row)
+                        changed = True
+            session.commit()
+        return changed
+
+    async def desired_commands(self) -> dict:
+        '''
+        Return the definitions of the registered slash commands by scope, which
+        is the guild ID or an empty string for global ones, and name
+        '''
+        interactions = self.client.interactions
+        commands = await interactions.to_dict()
+        scopes = {}
+        for scope, scope_commands in [(interactions.debug_guild, commands['global']), *commands['guild'].items()]:
+            desired = scopes.setdefault(str(scope) if scope else '', {})
+            for command in scope_commands:
+                command = {k: v for k, v in command.items() if k != 'permissions'}
+                desired[command['name']] = command
+        return scopes
+
+    async def check_commands(self, session) -> bool:
+        '''
+        Check that the hashes stored by the primary process match the slash
+        commands registered in this one, which requires processes to share the
+        database, returns whether they changed since the last check
+        '''
+        scopes = await self.desired_commands()
+        desired = {
+            (scope, name): command_digest(command)
+            for scope, commands in scopes.items()
+            for name, command in commands.items()
+        }
+        stored = {(row.scope, row.name): row.digest for (row,) in session.execute(sqlalchemy.select(self.CommandHash))}
+        if stored != desired:
+            raise RuntimeError('the primary process did not push the same commands yet')
+        changed = desired != self.known_commands
+        self.known_commands = desired
+        return changed
+
+    async def chunk(self, guild, user_ids=None) -> list:
+        '''
+        Fetch all members of a guild, or only the given ones, from the gateway
+
+        Members are only cached when fetching all of them if the cache policy
+        is "all", but specific members are always cached, since they are only
+        requested for the rules to apply to them
+        '''
+        if user_ids is None:
+            if self.cache_all and guild.chunked:
+                return guild.members
+            return await guild.chunk(cache=self.cache_all)
+
+        user_ids = list(user_ids)
+        members = []
+        for i in range(0, len(user_ids), 100):
+            members.extend(await guild.query_members(user_ids=user_ids[i:i + 100], limit=100, cache=True))
+        found = {member.id for member in members}
+        retry = time.monotonic() + self.missing_ttl
+        for user_id in user_ids:
+            if user_id in found:
+                self.missing.pop((guild.id, user_id), None)
+            else:
+                self.missing[(guild.id, user_id)] = retry
+        return members
+
+    def remember(self, guild, members):
+        '''
+        Cache members that were fetched without being cached
+        '''
+        for member in members:
+            guild._add_member(member)
+
+    async def member(self, guild, user_id: int):
+        '''
+        Get a member from the cache, fetching and caching it if missing, unless
+        it was recently found not to be in the guild
+        '''
+        member = guild.get_member(user_id)
+        if member is None:
+            retry = self.missing.get((guild.id, user_id), None)
+            if retry is not None:
+                if retry > time.monotonic():
+                    return None
+                del self.missing[(guild.id, user_id)]
+            members = await self.chunk(guild, [user_id])
+            member = members[0] if len(members) > 0 else None
+        return member
+
+    @core.event('discord.member_join')
+    async def on_member_join(self, member):
+        self.missing.pop((member.guild.id, member.id), None)
 
     @core.event('discord.socket_response')
     async def on_socket_response(self, msg):
-        if msg['t'] != 'INTERACTION_CREATE':
+        if msg['t'] != 'INTERACTION_CREATE' or msg['d']['type'] not in (2, 4):
             return
-        interaction = msg['d']['data']
+        key, options = parse_interaction(msg['d']['data'])
+        if msg['d']['type'] == 4:
+            return await self.complete(msg['d'], key, options)
+
+        command = self.routes.get(key, None)
+        if command is None:
+            return
+
         ctx = discord_slash.context.SlashContext(
             self.client.interactions.req,
             msg['d'],
             self.client,
             self.client.interactions.logger
         )
-
-        name = [interaction['name']]
-        options = []
-        options, grpname = partition(lambda o: o['type'] in (1, 2), interaction['options'])
-        if len(grpname) > 0:
-            name.append(grpname[0]['name'])
-            grpoptions, subname = partition(lambda o: o['type'] in (1, 2), grpname[0].get('options', []))
-            options.extend(grpoptions)
-            if len(subname) > 0:
-                name.append(subname[0]['name'])
-                options.extend(subname[0]['options'])
         options = await self.client.interactions.process_options(
             ctx.guild,
             options,
             {},
             {},
         )
+        await command.func(ctx, **options)
 
-        for reg in self.core.registered('discord.command', *name):
-            await reg.wrapped.func(ctx, **options)
+    async def complete(self, interaction, key, options):
+        '''
+        Answer an autocompletion interaction with the choices returned by the
+        handler for the focused option, or with none if there is no handler
+        '''
+        focused = next((o for o in options if o.get('focused', False)), None)
+        handler = self.completions.get((key, focused['name']), None) if focused is not None else None
+        choices = []
+        if handler is not None:
+            choices = await handler(focused.get('value', ''))
+        choices = [c if isinstance(c, dict) else {'name': str(c), 'value': c} for c in choices[:25]]
+        await self.client.interactions.req.post_initial_response(
+            {'type': 8, 'data': {'choices': choices}},
+            interaction['id'],
+            interaction['token'],
+        )
 
     @core.transform('discord.command')
     def make_command(self, reg, hdl, *args, **kwargs):
@@ -190,36 +714,75 @@ class Client(frobo.Cog):
     @cli.command('start', 'Connect to Discord and dispatch events')
     async def on_start(self):
         await self.client.start(self.config.get('discord.token'))
-        await self.interactions.sync_all_commands()
 
 class Permissions(frobo.Cog):
     dependencies = ['config', 'discord.client']
 
     client: discord.client
 
-    @core.event('discord.guild_join')
-    async def on_guild_join(self, guild, custom_target=None):
-        target = custom_target or guild.owner
-        target_id = target.id
-        permissions = await self.client.client.interactions.req.get_all_guild_commands_permissions(guild.id)
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.commands = None
+        self.guilds = {}
+
+    async def get_commands(self):
+        '''
+        Return the restricted commands of the bot indexed by id, fetching them
+        from Discord only once
+        '''
+        if self.commands is None:
+            commands = await self.client.client.interactions.req.get_all_commands(self.client.config.get('discord.debug-guild'))
+            self.commands = {com['id']: com for com in commands if not com.get('default_permission', True)}
+        return self.commands
+
+    async def get_permissions(self, guild_id):
+        '''
+        Return the command permissions of a guild indexed by command and target
+        id, fetching them from Discord only once
+        '''
+        if guild_id not in self.guilds:
+            permissions = await self.client.client.interactions.req.get_all_guild_commands_permissions(guild_id)
+            self.guilds[guild_id] = index_permissions(permissions)
+        return self.guilds[guild_id]
+
+    async def set_permission(self, guild_id, targets, permission):
+        '''
+        Allow or deny a list of (id, type) targets on all restricted commands of
+        a guild, only pushing the permissions to Discord if they changed
+        '''
+        commands = await self.get_commands()
+        permissions = await self.get_permissions(guild_id)
         updated = False
-        for com in await self.client.client.interactions.req.get_all_commands(self.client.config.get('discord.debug-guild')):
-            if com.get('default_permission', True) == True:
-                continue
-            perm = find_by(permissions, lambda p: p['id'] == com['id'], {'id': com['id'], 'permissions': []})
-            res = find_by(perm['permissions'], lambda u: u['id'] == target_id, {'id': target_id, 'type': 2, 'permission': False})
-            if res['permission'] == False:
-                updated = True
-                res['permission'] = True
+        for target_id, target_type in targets:
+            updated = set_permission(permissions, commands, str(target_id), target_type, permission) or updated
         if updated:
-            print(permissions)
-            await self.client.client.interactions.req.update_guild_commands_permissions(guild.id, permissions)
+            try:
+                await self.client.client.interactions.req.update_guild_commands_permissions(guild_id, flatten_permissions(permissions))
+            except BaseException as e:
+                # Our copy may not match Discord anymore, refetch it next time
+                self.guilds.pop(guild_id, None)
+                raise e
+        return updated
 
-    @core.event('discord.ready')
-    async def on_ready(self):
-        for guild in self.client.client.guilds:
-            await self.on_guild_join(guild)
-            await self.on_guild_join(guild, custom_target=guild.get_member('176428364595331072'))
+    @core.event('discord.guild_join')
+    async def on_guild_join(self, guild):
+        targets = [guild.owner_id, *self.client.config.get_list('discord.trusted')]
+        await self.set_permission(guild.id, [(target, 2) for target in targets], True)
+
+    @core.event('discord.commands_synced')
+    async def on_commands_synced(self, changed):
+        # Restricted commands may have appeared or changed ids
+        if not changed and self.commands is not None:
+            return
+        self.commands = None
+        self.guilds = {}
+        await self.get_commands()
+
+        semaphore = asyncio.Semaphore(self.client.config.get_int('discord.permissions.concurrency', 8))
+        async def sync(guild):
+            async with semaphore:
+                await self.on_guild_join(guild)
+        await self.core.gather(map(sync, self.client.client.guilds))
 
     @discord.command(
         'permissions', 'trust',
@@ -242,15 +805,7 @@ class Permissions(frobo.Cog):
             if target is None:
                 await ctx.send('⚠️ Invalid argument')
                 return
-        permissions = await self.client.client.interactions.req.get_all_guild_commands_permissions(ctx.guild_id)
-        for com in await self.client.client.interactions.req.get_all_commands(self.client.config.get('discord.debug-guild')):
-            if com.get('default_permission', True) == True:
-                continue
-            perm = find_by(permissions, lambda p: p['id'] == com['id'], {'id': com['id'], 'permissions': []})
-            res = find_by(perm['permissions'], lambda u: u['id'] == target_id, {'id': target_id, 'type': id_type, 'permission': True})
-            if res['permission'] == False:
-                res['permission'] = True
-        await self.client.client.interactions.req.update_guild_commands_permissions(ctx.guild_id, permissions)
+        await self.set_permission(ctx.guild_id, [(target_id, id_type)], True)
         await ctx.send(f'\u2705 Trusting {target.mention} to use privileged commands', hidden=True)
 
     @discord.command(
@@ -281,25 +836,18 @@ class Permissions(frobo.Cog):
             await ctx.send('⚠️ Cannot cease trusting yourself')
             return
 
-        permissions = await self.client.client.interactions.req.get_all_guild_commands_permissions(ctx.guild_id)
-        for com in await self.client.client.interactions.req.get_all_commands(self.client.config.get('discord.debug-guild')):
-            if com.get('default_permission', True) == True:
-                continue
-            perm = find_by(permissions, lambda p: p['id'] == com['id'], {'id': com['id'], 'permissions': []})
-            res = find_by(perm['permissions'], lambda u: u['id'] == target_id, {'id': target_id, 'type': id_type, 'permission': False})
-            if res['permission'] == True:
-                res['permission'] = False
-        await self.client.client.interactions.req.update_guild_commands_permissions(ctx.guild_id, permissions)
+        await self.set_permission(ctx.guild_id, [(target_id, id_type)], False)
         await ctx.send(f'\u2705 Ceasing to trust {target.mention} to use privileged commands', hidden=True)
 
 class Roles(frobo.Cog):
-    dependencies = ['discord.client', 'sql']
+    dependencies = ['config', 'discord.client', 'sql']
 
     client: discord.client
+    config: config.manager
 
     CONDITION_FMT = re.compile(r'\s*(?P<key>[^\s=!<@>\^\$\~%]+)\s*(?P<cond>[=!<@>\^\$\~%])=\s*("(?P<quoted>[^"]*)"|(?P<value>\S+))')
 
-    @sql.model('conditions')
+    @sql.model('conditions', indexes=['rule_id'])
     class Condition:
         id     : sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
         key    : sqlalchemy.Column(sqlalchemy.String)
@@ -307,13 +855,22 @@ class Roles(frobo.Cog):
         value  : sqlalchemy.Column(sqlalchemy.String)
         rule_id: sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('rules.id'))
 
-    @sql.model('rules')
+    @sql.model('rules', indexes=[('guild', 'role')])
     class Rule:
         id        : sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
         guild     : sqlalchemy.Column(sqlalchemy.String)
         role      : sqlalchemy.Column(sqlalchemy.String)
         conditions: sqlalchemy.orm.relationship('Condition', cascade='all, delete, delete-orphan')
 
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.rules = None
+
+    @sql.migration(1, 'Index rule lookups')
+    def index_lookups(self, migrator):
+        migrator.create_index('rules', 'guild', 'role')
+        migrator.create_index('conditions', 'rule_id')
+
     async def show_progress(self, ctx, label, progress, total, extra='', smsg=None):
         percentage = progress * 20 // total
         width = len(str(total))
@@ -325,41 +882,132 @@ class Roles(frobo.Cog):
         return await ctx.send(text)
      
 
+    def get_rules(self, session, guild_id=None) -> list[CachedRule]:
+        '''
+        Return the cached rules of a guild, or of all guilds, ordered by role
+
+        All rules are loaded at once with their conditions on first use, then
+        kept up to date by the commands that edit them
+        '''
+        if self.rules is None:
+            query = sqlalchemy.select(self.Rule).options(sqlalchemy.orm.selectinload(self.Rule.conditions))
+            rules = {}
+            for (rule,) in session.execute(query):
+                cached = CachedRule.from_model(rule)
+                rules.setdefault(cached.guild, []).append(cached)
+            for guild_rules in rules.values():
+                guild_rules.sort(key=CachedRule.sort_key)
+            self.rules = rules
+        if guild_id is not None:
+            return self.rules.get(str(guild_id), [])
+        return list(itertools.chain.from_iterable(self.rules.values()))
+
+    def cache_rule(self, rule: CachedRule):
+        if self.rules is None:
+            return
+        guild_rules = self.rules.setdefault(rule.guild, [])
+        guild_rules.append(rule)
+        guild_rules.sort(key=CachedRule.sort_key)
+
+    def uncache_rule(self, guild_id, rule_id: int):
+        if self.rules is None:
+            return
+        guild_rules = self.rules.get(str(guild_id), [])
+        self.rules[str(guild_id)] = [r for r in guild_rules if r.id != rule_id]
+
+    async def get_subjects(self) -> set[int]:
+        '''
+        Return the IDs of users that profile providers know something about
+        '''
+        subjects = set()
+        for reg in self.core.registered('discord.roles.subjects'):
+            subjects.update(map(int, await reg.wrapped()))
+        return subjects
+
+    async def fetch_profile(self, user):
+        '''
+        Gather the profiles of a user from all discord.roles.profile providers,
+        returning them along with whether all providers answered in time
+        '''
+        profile = {}
+        complete = True
+        outcomes = await self.core.invoke(
+            'discord.roles.profile',
+            user,
+            timeout=self.config.get_float('discord.roles.profile-timeout', 10.0),
+            outcomes=True,
+        )
+        for outcome in outcomes:
+            key = outcome.registration.args[0]
+            if outcome.ok:
+                profile[key] = outcome.value
+                continue
+            complete = False
+            reason = 'timed out' if outcome.timed_out else repr(outcome.exception)
+            print(f'\033[91;1mProfile {key} of user {user.id} unavailable: {reason}\033[0m')
+        return profile, complete
+
+    def match(self, rule, profile) -> bool:
+        '''
+        Tell whether a profile meets all conditions of a rule
+        '''
+        for condition in rule.conditions:
+            if not do_test(get_profile_value(profile, condition.key), condition.cond, condition.value):
+                return False
+        return True
+
+    def match_all(self, rules, profiles):
+        '''
+        Evaluate rules on many profiles at once, returning the roles involved
+        and a profile by role matrix telling which roles each profile gets
+        '''
+        import numpy
+        roles = sorted({rule.role for rule in rules})
+        indexes = {role: i for i, role in enumerate(roles)}
+        matrix = numpy.zeros((len(profiles), len(roles)), dtype=bool)
+        columns = {}
+        tests = {}
+        for rule in rules:
+            matched = numpy.ones(len(profiles), dtype=bool)
+            for condition in rule.conditions:
+                test = (condition.key, condition.cond, condition.value)
+                if test not in tests:
+                    if condition.key not in columns:
+                        columns[condition.key] = ProfileColumn(profiles, condition.key)
+                    tests[test] = columns[condition.key].test(condition.cond, condition.value)
+                matched &= tests[test]
+            matrix[:, indexes[rule.role]] |= matched
+        return roles, matrix
+
     async def update_user(self, ctx, session, user, progress=False, guild=None):
         if progress and ctx is not None:
             await ctx.defer(hidden=True)
         guild = guild if guild else (ctx.guild if ctx is not None else None)
-        query = sqlalchemy.select(self.Rule)
-        if guild is not None:
-            query = query.where(self.Rule.guild == str(guild.id))
-        query = query.order_by('role')
-        rules = list(map(lambda r: r[0], session.execute(query)))
+        rules = self.get_rules(session, guild.id if guild is not None else None)
         to_unapply = {}
         to_apply = {}
         for rule in rules:
             to_unapply.setdefault(rule.guild, set()).add(rule.role)
 
-        set(map(lambda r: (r.guild, r.role), rules))
-
-        profile = {}
-        for profile_entry in self.core.registered('discord.roles.profile'):
-            profile[profile_entry.args[0]] = await profile_entry.wrapped(user)
+        profile, complete = await self.fetch_profile(user)
+        if not complete:
+            # Missing profiles would wrongly fail conditions, only add roles
+            to_unapply = {}
         for rule in rules:
-            matched = True
-            for condition in rule.conditions:
-                real_value = get_profile_value(profile, condition.key)
-                matched = matched and do_test(real_value, condition.cond, condition.value)
-            if matched:
+            if self.match(rule, profile):
                 to_apply.setdefault(rule.guild, set()).add(rule.role)
                 tug = to_unapply.setdefault(rule.guild, set())
                 if rule.role in tug:
                     tug.remove(rule.role)
 
         for guild_id in set(itertools.chain(to_apply.keys(), to_unapply.keys())):
-            guild = self.client.client.get_guild(guild_id)
+            guild = self.client.client.get_guild(int(guild_id))
             if guild is None:
                 continue
-            member = guild.get_member(user.id)
+            if isinstance(user, discord.Member) and user.guild.id == guild.id:
+                member = user
+            else:
+                member = await self.client.member(guild, user.id)
             if member is None:
                 continue
             await member.remove_roles(*map(lambda x: discord.utils.get(guild.roles, id=int(x)), to_unapply.get(guild_id, set())))
@@ -371,21 +1019,68 @@ class Roles(frobo.Cog):
         # TODO: Implement
         await ctx.send('NYI: Update Role')
     
+    @core.event('discord.roles.stale')
+    async def on_stale(self, user_ids, session: sql.session):
+        # Profiles of these users changed, their roles may have too
+        for user_id in user_ids:
+            try:
+                user = self.client.client.get_user(int(user_id))
+                if user is None:
+                    user = await self.client.client.fetch_user(int(user_id))
+                await self.update_user(None, session, user)
+            except discord.errors.HTTPException as e:
+                print(f'\033[91;1mCould not update the roles of user {user_id}: {e}\033[0m')
+
     async def update_all(self, ctx, session, progress=False):
-        count = len(ctx.guild.members)
         if progress:
-            prog = await self.show_progress(ctx, 'Warming up...', 0, count)
+            # Fetching members may outlast the delay to answer the interaction
+            await ctx.defer()
+        members = await self.client.chunk(ctx.guild)
+        if not self.client.cache_all:
+            # Keep the members that rules apply to around for later updates
+            subjects = await self.get_subjects()
+            self.client.remember(ctx.guild, [m for m in members if m.id in subjects and ctx.guild.get_member(m.id) is None])
+        count = len(members)
+        prog = None
+        shown = 0
+        async def show(label, done, extra=''):
+            # Editing the message for every member would be rate limited
+            nonlocal prog, shown
+            if progress and (prog is None or done == count or time.monotonic() - shown >= 1):
+                shown = time.monotonic()
+                prog = await self.show_progress(ctx, label, done, count, extra, prog)
+
+        await show('Fetching profiles...', 0)
+        fetched = 0
+        semaphore = asyncio.Semaphore(self.config.get_int('discord.roles.concurrency', 16))
+        async def fetch(member):
+            nonlocal fetched
+            async with semaphore:
+                result = await self.fetch_profile(member)
+            fetched += 1
+            await show('Fetching profiles...', fetched)
+            return result
+        results = await self.core.gather(map(fetch, members))
+
+        roles, matrix = self.match_all(self.get_rules(session, ctx.guild.id), [profile for profile, _ in results])
         errors = 0
-        for i, member in enumerate(ctx.guild.members):
+        for i, member in enumerate(members):
+            current = {str(role.id) for role in member.roles}
+            wanted = {roles[j] for j in matrix[i].nonzero()[0]}
+            to_apply = wanted - current
+            # Missing profiles would wrongly fail conditions, only add roles
+            to_unapply = (current & set(roles)) - wanted if results[i][1] else set()
             try:
-                await self.update_user(ctx, session, member)
+                if len(to_unapply) > 0:
+                    await member.remove_roles(*filter(None, map(lambda x: ctx.guild.get_role(int(x)), to_unapply)))
+                if len(to_apply) > 0:
+                    await member.add_roles(*filter(None, map(lambda x: ctx.guild.get_role(int(x)), to_apply)))
             except discord.errors.Forbidden as e:
                 if progress:
                     errors += 1
                 else:
                     raise e from None
-            if progress:
-                await self.show_progress(ctx, f'Processed {member.mention}', i+1, count, ('' if errors == 0 else f'⚠️ {errors} errors occured'), prog)
+            await show(f'Processed {member.mention}', i + 1, '' if errors == 0 else f'⚠️ {errors} errors occured')
         if progress:
             if errors == 0:
                 await prog.edit(content=f'\u2705 {count} users processed!')
@@ -403,6 +1098,8 @@ class Roles(frobo.Cog):
         ],
     )
     async def watch(self, ctx, role, condition, session: sql.session):
+        # Load the cache first, so that it does not pick the new rule up twice
+        self.get_rules(session, ctx.guild_id)
         conditions = []
         for match in self.CONDITION_FMT.finditer(condition):
             conditions.append(self.Condition(
@@ -413,12 +1110,14 @@ class Roles(frobo.Cog):
 
         rule = self.Rule(
             guild=str(ctx.guild_id),
-            role=role.id,
+            role=str(role.id),
             conditions=conditions,
         )
         session.add(rule)
-        session.commit()
         session.flush()
+        cached = CachedRule.from_model(rule)
+        session.commit()
+        self.cache_rule(cached)
 
         await ctx.send('\u2705 Rule created! It will be processed on the next /roles update')
 
@@ -432,16 +1131,14 @@ class Roles(frobo.Cog):
     )
     async def show(self, ctx, role=None, *, session: sql.session):
         await ctx.defer()
-        query = sqlalchemy.select(self.Rule).where(self.Rule.guild == str(ctx.guild_id))
+        rules = self.get_rules(session, ctx.guild_id)
         if role is not None:
-            query = query.where(self.Rule.role == str(role.id))
-        query = query.order_by('role')
+            rules = [rule for rule in rules if rule.role == str(role.id)]
         last_role_id = None
         contents = '```\n'
 
         orphaned = 0
-        for row in session.execute(query):
-            row = row[0]
+        for row in rules:
             if last_role_id != row.role:
                 last_role_id = row.role
                 role = ctx.guild.get_role(int(row.role))
@@ -475,15 +1172,15 @@ class Roles(frobo.Cog):
     )
     async def clear(self, ctx, rule, *, session: sql.session):
         await ctx.defer(hidden=True)
-        rule = session.get(self.Rule, rule)
-        if rule is None:
+        # The cache may still hold a rule another process already deleted
+        row = session.get(self.Rule, rule)
+        if row is None or row.guild != str(ctx.guild_id):
+            self.uncache_rule(ctx.guild_id, rule)
             await ctx.send('⚠️ Rule not found')
         else:
-            session.delete(rule)
+            session.delete(row)
             session.commit()
-            session.flush()
-            await ctx.guild.fetch_roles()
-            role = discord.utils.get(ctx.guild.roles, id=int(rule.role))
+            self.uncache_rule(ctx.guild_id, rule)
             await ctx.send('\U0001f5d1\ufe0f Rule deleted, it will be cleaned up on the next `/roles update`')
 
     @discord.command(
@@ -508,3 +1205,43 @@ class Roles(frobo.Cog):
                     await self.update_role(ctx, session, role, progress=True)
                 else:
                     await ctx.send('⚠️ Invalid argument')
+
+class Status(frobo.Cog):
+    dependencies = ['discord.client']
+
+    client: discord.client
+
+    @discord.command(
+        'status', 'members',
+        description='Show how many members are cached for each guild',
+        base_default_permission=False,
+    )
+    async def members(self, ctx):
+        await ctx.defer(hidden=True)
+        policy = 'all' if self.client.cache_all else 'rules'
+        contents = f'Member cache policy: {policy}\n```\n'
+        cached_total = 0
+        for guild in sorted(self.client.client.guilds, key=lambda g: g.name):
+            cached = len(guild.members)
+            total = guild.member_count or 0
+            cached_total += cached
+            contents += f'{guild.name[:32]:32s} {cached:7d}/{total:<7d}{" (chunked)" if guild.chunked else ""}\n'
+        contents += f'\n{"Total":32s} {cached_total:7d}\n```'
+        await ctx.send(contents, hidden=True)
+
+    @discord.command(
+        'status', 'shards',
+        description='Show the latency and guild count of each shard connected from this process',
+        base_default_permission=False,
+    )
+    async def shards(self, ctx):
+        await ctx.defer(hidden=True)
+        client = self.client.client
+        guilds = collections.Counter(client.shard_of(guild.id) for guild in client.guilds)
+        contents = f'Shards: {client.shard_count or 1}\n```\n'
+        for shard_id, latency in self.client.latencies():
+            # Latency is infinite or NaN until the first heartbeat is acknowledged
+            shown = f'{latency * 1000:8.1f}ms' if math.isfinite(latency) else f'{"-":>10s}'
+            contents += f'Shard {shard_id:<5d} {shown} {guilds[shard_id]:7d} guilds\n'
+        contents += '```'
+        await ctx.send(contents, hidden=True)
@@ -1,6 +1,10 @@
 import os, os.path
 import aiohttp
+import asyncio
+import bisect
+import datetime
 import frobo
+import json
 import random
 import sqlalchemy, sqlalchemy.orm
 import urllib.parse
@@ -9,58 +13,156 @@ from discord_slash.model import ButtonStyle
 from discord_slash.utils.manage_commands import create_option, get_all_commands
 from discord_slash.utils.manage_components import create_actionrow, create_button
 from jwt import decode, PyJWKClient
+from typing import Optional
+
+# How many intra profiles are fetched at once
+FETCH_CONCURRENCY = 4
+
+class Directory:
+    '''
+    Links between Discord users and Epitech logins, indexed both ways, with
+    logins also kept sorted to search them by prefix
+
+    Logins are looked up and searched ignoring case, owners being keyed by
+    casefolded login
+    '''
+
+    def __init__(self, links=()):
+        self.logins = {}
+        self.owners = {}
+        self.sorted = []
+        for user_id, login in links:
+            self.add(user_id, login)
+
+    def add(self, user_id: str, login: str):
+        key = login.casefold()
+        if key in self.owners:
+            self.remove(self.owners[key], login)
+        self.owners[key] = user_id
+        self.logins.setdefault(user_id, set()).add(login)
+        bisect.insort(self.sorted, (key, login))
+
+    def remove(self, user_id: str, login: str=None):
+        '''
+        Remove one login of a user, or all of them
+        '''
+        logins = self.logins.get(user_id, set())
+        if login is not None:
+            removed = [l for l in logins if l.casefold() == login.casefold()]
+        else:
+            removed = list(logins)
+        for login in removed:
+            key = login.casefold()
+            if self.owners.get(key, None) != user_id:
+                continue
+            del self.owners[key]
+            logins.discard(login)
+            del self.sorted[bisect.bisect_left(self.sorted, (key, login))]
+        if len(logins) == 0:
+            self.logins.pop(user_id, None)
+
+    def owner(self, login: str) -> Optional[str]:
+        '''
+        Return the ID of the user a login is linked to, ignoring case
+        '''
+        return self.owners.get(login.casefold(), None)
+
+    def search(self, prefix: str, limit: int=25) -> list[str]:
+        '''
+        Return the first logins starting with a prefix, ignoring case
+        '''
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.sorted, (prefix,))
+        matches = []
+        for key, login in self.sorted[start:start + limit]:
+            if not key.startswith(prefix):
+                break
+            matches.append(login)
+        return matches
 
 class Registrations(frobo.Cog):
     dependencies = ['config', 'discord', 'sql', 'web']
 
     config: config.manager
+    ephemeral: sql.ephemeral
     roles: discord.roles
     discord: discord.client
+    web: web.server
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.directory = None
+
+    @core.event('discord.ready')
+    async def on_ready(self, sql: sql.session):
+        # Load links ahead of the first lookup, which has to answer quickly
+        self.get_directory(sql)
+
+    def get_directory(self, session) -> Directory:
+        '''
+        Return the directory of linked accounts, loading it on first use
+        '''
+        if self.directory is None:
+            query = sqlalchemy.select(self.EpitechUser.discord, self.EpitechUser.azure)
+            self.directory = Directory(session.execute(query))
+        return self.directory
 
     def render(self, status, message, subtitle):
+        # Read through the loader, as this module may come from a bundle
         template_path = os.path.join(os.path.dirname(__file__), 'authorized_template.html')
         is_error = status < 200 or status >= 400
-        with open(template_path) as f:
-            html = f.read() \
-                .replace('%TITLE%', message) \
-                .replace('%SUBTITLE%', subtitle) \
-                .replace('%CLASS%', 'error' if is_error else 'ok') \
-                .replace('%ICON%', 'link_off' if is_error else 'link')
-            return Response(
-                status=status,
-                text=html,
-                content_type='text/html',
-            )
+        html = __loader__.get_data(template_path).decode('utf-8') \
+            .replace('%TITLE%', message) \
+            .replace('%SUBTITLE%', subtitle) \
+            .replace('%CLASS%', 'error' if is_error else 'ok') \
+            .replace('%ICON%', 'link_off' if is_error else 'link')
+        return Response(
+            status=status,
+            text=html,
+            content_type='text/html',
+        )
 
-    @sql.model('epitech_users')
+    @sql.model('epitech_users', indexes=['discord'])
     class EpitechUser:
         id:      sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
         discord: sqlalchemy.Column(sqlalchemy.String)
         azure:   sqlalchemy.Column(sqlalchemy.String, unique=True)
 
-    @sql.model('epitech_interactions')
-    class Interaction:
-        id:        sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-        snowflake: sqlalchemy.Column(sqlalchemy.String)
-        guild:     sqlalchemy.Column(sqlalchemy.String)
-        user:      sqlalchemy.Column(sqlalchemy.String, unique=True)
-        nonce:     sqlalchemy.Column(sqlalchemy.Integer)
+    @sql.model('epitech_profiles', indexes=['fetched'])
+    class ProfileSnapshot:
+        login:   sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        data:    sqlalchemy.Column(sqlalchemy.Text)
+        fetched: sqlalchemy.Column(sqlalchemy.DateTime)
+
+    @sql.migration(1, 'Index account and interaction lookups')
+    def index_lookups(self, migrator):
+        migrator.create_index('epitech_users', 'discord')
+        # Interactions have since moved out of the database
+        if migrator.has_table('epitech_interactions'):
+            migrator.create_index('epitech_interactions', 'snowflake')
+
+    @sql.migration(2, 'Track interaction creation time')
+    def track_interactions(self, migrator):
+        if migrator.has_table('epitech_interactions'):
+            migrator.add_column('epitech_interactions', sqlalchemy.Column('created', sqlalchemy.DateTime))
+
+    @sql.migration(3, 'Move interactions to the ephemeral store')
+    def drop_interactions(self, migrator):
+        migrator.drop_table('epitech_interactions')
 
     @web.route('GET', '/epitech/verify/{interaction}')
-    async def verify(self, request, sql: sql.session):
-        query = sqlalchemy.select(self.Interaction).where(self.Interaction.snowflake == request.match_info['interaction'])
-        interaction = sql.execute(query).first()
+    async def verify(self, request):
+        snowflake = request.match_info['interaction']
+        interaction = self.ephemeral.get('epitech.interactions', snowflake)
         if interaction is None:
             return self.render(404, 'Invalid interaction', 'Please try again, starting with the /epitech login command')
-        interaction = interaction[0]
-        interaction.nonce = random.randint(-2**31, 2**31)
-        sql.add(interaction)
-        sql.commit()
-        sql.flush()
+        nonce = random.randint(-2**31, 2**31)
+        self.ephemeral.put('epitech.nonces', snowflake, nonce, self.config.get_float('epitech.interaction-ttl', 900.0))
 
         base_uri = self.config.get('web.root-uri')
         tenant = self.config.get('epitech.azure.tenant')
-        auth_uri = f'https://login.microsoftonline.com/{tenant}/oauth2/v2.0/authorize?'
+        authority = self.config.get('epitech.azure.authority', 'https://login.microsoftonline.com')
+        auth_uri = f'{authority}/{tenant}/oauth2/v2.0/authorize?'
 
         return Response(status=302, headers={
             'Location': auth_uri + urllib.parse.urlencode({
@@ -69,8 +171,8 @@ class Registrations(frobo.Cog):
                 'redirect_uri':  f'{base_uri}/epitech/authorize',
                 'response_mode': 'form_post',
                 'scope':         'openid email',
-                'nonce':         str(interaction.nonce),
-                'state':         interaction.snowflake,
+                'nonce':         str(nonce),
+                'state':         snowflake,
             }),
         })
 
@@ -78,16 +180,18 @@ class Registrations(frobo.Cog):
     async def authorize(self, request, sql: sql.session):
         data = await request.post()
         if 'id_token' in data:
-            jwks = PyJWKClient(f'https://login.microsoftonline.com/common/discovery/keys')
+            authority = self.config.get('epitech.azure.authority', 'https://login.microsoftonline.com')
+            jwks = PyJWKClient(self.config.get('epitech.azure.jwks-uri', f'{authority}/common/discovery/keys'))
             key = jwks.get_signing_key_from_jwt(data['id_token'])
             claims = decode(data['id_token'], key.key, algorithms=['RS256'], audience=self.config.get('epitech.azure.client-id'))
-            interaction = sql.execute(sqlalchemy.select(self.Interaction).where(self.Interaction.snowflake == data['state'])).first()
+            interaction = self.ephemeral.pop('epitech.interactions', data['state'])
+            nonce = self.ephemeral.pop('epitech.nonces', data['state'])
             if interaction is None: 
                 return self.render(404, 'Invalid interaction', 'Please try again, starting with the /epitech login command')
-            if interaction[0].nonce != int(claims['nonce']):
+            if nonce != int(claims['nonce']):
                 return self.render(404, 'Invalid nonce', 'This request is not safe, please try again')
-            interaction = interaction[0]
-            user_id = interaction.user
+            user_id = interaction['user']
+            self.ephemeral.delete('epitech.logins', user_id)
 
             query = sqlalchemy.select(self.EpitechUser).where(
                 self.EpitechUser.discord == user_id,
@@ -102,34 +206,118 @@ class Registrations(frobo.Cog):
             ))
             sql.commit()
             sql.flush()
-            await self.roles.update_user(None, sql, self.discord.client.get_user(int(user_id)))
+            await self.web.dispatch('epitech.linked', user_id, claims['email'])
             
         if 'state' in data:
-            query = sqlalchemy.delete(self.Interaction).where(self.Interaction.snowflake == data['state'])
-            sql.execute(query)
-            sql.commit()
-            sql.flush()
+            self.ephemeral.delete('epitech.interactions', data['state'])
+            self.ephemeral.delete('epitech.nonces', data['state'])
         if 'id_token' not in data:
             return self.render(401, 'Authorization failed', 'Please try again, starting with the /epitech login command')
         return self.render(200, 'Accounts linked!', 'You can now close this tab')
 
+    @core.event('epitech.linked')
+    async def on_linked(self, user_id, login, sql: sql.session):
+        self.get_directory(sql).add(user_id, login)
+        await self.refresh(sql, [login])
+        # Users are not cached unless all members are
+        user = self.discord.client.get_user(int(user_id))
+        if user is None:
+            user = await self.discord.client.fetch_user(int(user_id))
+        await self.roles.update_user(None, sql, user)
+
+    @discord.roles.subjects
+    async def get_subjects(self, sql: sql.session):
+        query = sqlalchemy.select(self.EpitechUser.discord).distinct()
+        return [row[0] for row in sql.execute(query)]
+
+    async def refresh(self, session, logins) -> list[str]:
+        '''
+        Fetch the intra profiles of logins and store them as snapshots,
+        returning the logins whose profile changed
+
+        Failed fetches keep the previous snapshot, but still count as a
+        refresh so that other logins get their turn, and logins that were never
+        fetched successfully get no snapshot at all
+        '''
+        token = self.config.get('epitech.intra.token')
+        intra_uri = self.config.get('epitech.intra.uri', 'https://intra.epitech.eu')
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        async def fetch(http, login):
+            async with semaphore:
+                try:
+                    async with http.get(f'{intra_uri}/auth-{token}/user/{login}/?format=json') as resp:
+                        data = await resp.json()
+                        # The intra answers errors with a JSON body too
+                        if resp.status != 200 or not isinstance(data, dict) or 'error' in data:
+                            print(f'\033[91;1mCould not fetch the intra profile of {login}: HTTP {resp.status}\033[0m')
+                            return login, None
+                        return login, data
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    print(f'\033[91;1mCould not fetch the intra profile of {login}: {e!r}\033[0m')
+                    return login, None
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as http:
+            results = await self.core.gather(fetch(http, login) for login in logins)
+
+        query = sqlalchemy.select(self.ProfileSnapshot).where(self.ProfileSnapshot.login.in_(logins))
+        snapshots = {row[0].login: row[0] for row in session.execute(query)}
+        fetched = datetime.datetime.utcnow()
+        changed = []
+        for login, data in results:
+            snapshot = snapshots.get(login, None)
+            if snapshot is None:
+                if data is None:
+                    continue
+                snapshot = self.ProfileSnapshot(login=login)
+                session.add(snapshot)
+            snapshot.fetched = fetched
+            if data is None:
+                continue
+            data = json.dumps(data, sort_keys=True)
+            if snapshot.data != data:
+                snapshot.data = data
+                changed.append(login)
+        session.commit()
+        return changed
+
+    @core.periodic(interval=60, jitter=10)
+    async def synchronize(self, sql: sql.session):
+        # Web workers and other shards' processes mount this cog too, leave
+        # synchronization to the primary process
+        if self.web.relay is not None or not self.discord.is_primary():
+            return
+        budget = self.config.get_int('epitech.sync.budget', 50)
+        if budget <= 0:
+            return
+        # Stalest first, starting with the ones never fetched
+        query = sqlalchemy.select(self.EpitechUser.azure) \
+            .outerjoin(self.ProfileSnapshot, self.ProfileSnapshot.login == self.EpitechUser.azure) \
+            .order_by(self.ProfileSnapshot.fetched.is_(None).desc(), self.ProfileSnapshot.fetched) \
+            .limit(budget)
+        changed = await self.refresh(sql, [row[0] for row in sql.execute(query)])
+        if len(changed) == 0:
+            return
+        directory = self.get_directory(sql)
+        users = sorted({directory.owner(login) for login in changed} - {None})
+        await self.core.emit('discord.roles.stale', users)
+
     @discord.roles.profile('epitech')
     async def get_profile(self, member, sql: sql.session):
-        query = sqlalchemy.select(self.EpitechUser).where(self.EpitechUser.discord == str(member.id))
+        logins = list(self.get_directory(sql).logins.get(str(member.id), ()))
+        query = sqlalchemy.select(self.ProfileSnapshot).where(self.ProfileSnapshot.login.in_(logins))
+        snapshots = {row[0].login: row[0] for row in sql.execute(query)}
+        missing = [login for login in logins if login not in snapshots]
+        if len(missing) > 0:
+            # Linked before the synchronizer got to them
+            await self.refresh(sql, missing)
+            snapshots = {row[0].login: row[0] for row in sql.execute(query)}
+
         profiles = []
-        for user in sql.execute(query):
-            if user is None:
-                return None
-            user = user[0]
-
-            token = self.config.get('epitech.intra.token')
-            data = None
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'https://intra.epitech.eu/auth-{token}/user/{user.azure}/?format=json') as resp:
-                    data = await resp.json()
-                    if 'error' not in data:
-                        profiles.append(data)
-        
+        for snapshot in snapshots.values():
+            if snapshot.data is None:
+                continue
+            data = json.loads(snapshot.data)
+            if 'error' not in data:
+                profiles.append(data)
         if len(profiles) == 0:
             return None
         return profiles
@@ -140,17 +328,19 @@ class Registrations(frobo.Cog):
         base_default_permission=True,
         options=[],
     )
-    async def login(self, ctx, sql: sql.session):
+    async def login(self, ctx):
         await ctx.defer(hidden=True)
-        sql.execute(sqlalchemy.delete(self.Interaction).where(self.Interaction.user == str(ctx.author_id)))
-        sql.add(self.Interaction(
-            snowflake=ctx.interaction_id,
-            guild=ctx.guild_id,
-            user=ctx.author_id,
-        ))
+        user_id = str(ctx.author_id)
+        ttl = self.config.get_float('epitech.interaction-ttl', 900.0)
+        # Only the latest link sent to a user stays valid
+        previous = self.ephemeral.get('epitech.logins', user_id)
+        if previous is not None:
+            self.ephemeral.delete('epitech.interactions', previous)
+            self.ephemeral.delete('epitech.nonces', previous)
+        snowflake = str(ctx.interaction_id)
+        self.ephemeral.put('epitech.interactions', snowflake, {'guild': str(ctx.guild_id), 'user': user_id}, ttl)
+        self.ephemeral.put('epitech.logins', user_id, snowflake, ttl)
 
-        sql.commit()
-        sql.flush()
         base_uri = self.config.get('web.root-uri')
         await ctx.send(
             "Alright, please sign in to Azure with your Epitech account by clicking on the button:",
@@ -169,14 +359,46 @@ class Registrations(frobo.Cog):
         ],
     )
     async def whois(self, ctx, user, sql: sql.session):
-        await ctx.defer(hidden=True)
-        query = sqlalchemy.select(self.EpitechUser).where(self.EpitechUser.discord == str(user.id))
-        result = sql.execute(query)
-        logins = list(map(lambda row: f'    - {row[0].azure}', result))
-        text = '\n'.join(logins)
+        logins = sorted(self.get_directory(sql).logins.get(str(user.id), ()))
+        text = '\n'.join(map(lambda login: f'    - {login}', logins))
 
         if len(logins) == 0:
             return await ctx.send('⚠️ No logins found', hidden=True)
         await ctx.send(f'🔎 The following logins were found:\n{text}', hidden=True)
 
+    @discord.command(
+        'epitech', 'lookup',
+        description='Find whose user account an Epitech login is linked to',
+        base_default_permission=True,
+        options=[
+            {**create_option('login', description='The login you want to know the owner of', option_type=3, required=True), 'autocomplete': True},
+        ],
+    )
+    async def lookup(self, ctx, login, sql: sql.session):
+        owner = self.get_directory(sql).owner(login)
+        if owner is None:
+            return await ctx.send('⚠️ Nobody linked this login', hidden=True)
+        await ctx.send(f'🔎 {login} is linked to <@{owner}>', hidden=True)
+
+    @discord.autocomplete('epitech', 'lookup', 'login')
+    async def complete_login(self, value, sql: sql.session):
+        return self.get_directory(sql).search(value)
+
+    @discord.command(
+        'epitech', 'unlink',
+        description='Unlink your Epitech accounts and lose the roles they gave you',
+        base_default_permission=True,
+        options=[],
+    )
+    async def unlink(self, ctx, sql: sql.session):
+        await ctx.defer(hidden=True)
+        user_id = str(ctx.author_id)
+        logins = list(self.get_directory(sql).logins.get(user_id, ()))
+        sql.execute(sqlalchemy.delete(self.EpitechUser).where(self.EpitechUser.discord == user_id))
+        sql.execute(sqlalchemy.delete(self.ProfileSnapshot).where(self.ProfileSnapshot.login.in_(logins)))
+        sql.commit()
+        self.get_directory(sql).remove(user_id)
+        await self.roles.update_user(None, sql, ctx.author)
+        await ctx.send('✅ Your accounts were unlinked', hidden=True)
+
     
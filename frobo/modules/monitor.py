@@ -0,0 +1,103 @@
+import asyncio
+import frobo
+import sys
+import threading
+import time
+
+# Finer than the default buckets, as a healthy loop lags well under 1ms
+LAG_BOUNDS = (0.0001, 0.00025, 0.0005, *frobo.util.Histogram.BOUNDS)
+
+class Loop(frobo.Cog):
+    '''
+    Measures how late the event loop wakes up from short sleeps, and reports
+    what was running whenever it gets blocked for longer than
+    monitor.slow-callback seconds
+
+    A watchdog thread samples the stack of the loop's thread while it is
+    blocked, so the culprit is found even in code that never yields
+
+    Measures start once the core has started, as importing and mounting
+    modules blocks the loop by nature
+    '''
+
+    dependencies = ['config']
+
+    config: config.manager
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.interval = self.config.get_float('monitor.interval', 0.1)
+        self.threshold = self.config.get_float('monitor.slow-callback', 0.25)
+        self.lag = frobo.util.Histogram(LAG_BOUNDS)
+        self.stalls = 0
+        self.culprit = None
+        self.loop_thread = threading.get_ident()
+        self.stopping = threading.Event()
+        self.watchdog = None
+        self.task = None
+        if self.core.started:
+            self.start()
+
+    @core.event('core.started')
+    async def on_started(self):
+        self.start()
+
+    @core.event('core.unmount')
+    async def on_unmount(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.stopping.set()
+        if self.watchdog is not None:
+            await self.core.loop.run_in_executor(None, self.watchdog.join)
+
+    def start(self):
+        self.beat = time.monotonic()
+        self.watchdog = threading.Thread(target=self.watch, name='frobo-loop-watchdog', daemon=True)
+        self.watchdog.start()
+        self.task = self.core.loop.create_task(self.measure())
+
+    async def measure(self):
+        while True:
+            start = self.core.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(self.core.loop.time() - start - self.interval, 0)
+            self.beat = time.monotonic()
+            self.lag.observe(lag)
+            culprit, self.culprit = self.culprit, None
+            if lag < self.threshold:
+                continue
+            self.stalls += 1
+            where = f' in {culprit}' if culprit is not None else ''
+            print(f'\033[93;1mEvent loop blocked for {lag:.3f}s{where}\033[0m')
+
+    def watch(self):
+        '''
+        Sample the stack of the loop's thread once it has not woken up in
+        time, keeping the innermost frame that belongs to a cog
+        '''
+        while not self.stopping.wait(self.threshold / 2):
+            if self.culprit is not None or time.monotonic() - self.beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread, None)
+            try:
+                self.culprit = self.locate(frame)
+            except RuntimeError:
+                # Modules changed while we looked, the loop is running again
+                pass
+
+    def locate(self, frame):
+        while frame is not None:
+            code = frame.f_code
+            owner = self.core.locate(code.co_filename, frame.f_lineno)
+            if owner is not None:
+                return f'{".".join(owner)} {code.co_name} ({code.co_filename}:{frame.f_lineno})'
+            frame = frame.f_back
+        return None
+
+    @core.injectable('monitor.lag')
+    def get_lag(self):
+        '''
+        Return event loop lag percentiles, in seconds, and how many times the
+        loop was blocked for longer than the threshold
+        '''
+        return {**self.lag.summary(), 'stalls': self.stalls, 'backend': type(self.core.loop).__module__}
@@ -0,0 +1,210 @@
+import aiohttp.web
+import asyncio
+import collections
+import discord.http
+import discord_slash.http
+import frobo
+import itertools
+import json
+import socket
+import time
+
+# Finer than the default buckets, as most events are handled in well under 1ms
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, *frobo.util.Histogram.BOUNDS)
+
+FAKE_USER = {'id': '1', 'username': 'frobo', 'discriminator': '0000', 'avatar': None, 'bot': True}
+
+def route_template(method: str, path: str) -> str:
+    '''
+    Turn a request path into the route it was made on, replacing snowflakes and
+    interaction tokens with placeholders
+    '''
+    segments = []
+    for segment in path.split('/'):
+        if segment.isdigit():
+            segment = '{id}'
+        elif len(segment) > 32:
+            segment = '{token}'
+        segments.append(segment)
+    return f'{method} /{"/".join(segments)}'
+
+class FakeApi:
+    '''
+    Answers Discord HTTP API requests locally with plausible payloads, keeping
+    count of the requests made on each route
+    '''
+
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.ids = itertools.count(1 << 42)
+        self.runner = None
+
+    async def start(self) -> str:
+        '''
+        Start listening on a free local port, returning the base URL to use
+        '''
+        app = aiohttp.web.Application()
+        app.router.add_route('*', '/api/{version}/{path:.*}', self.handle)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await aiohttp.web.SockSite(self.runner, sock).start()
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def message(self, body):
+        return {
+            'id': str(next(self.ids)),
+            'channel_id': '0',
+            'type': 0,
+            'content': '',
+            'author': FAKE_USER,
+            'attachments': [],
+            'embeds': [],
+            'mentions': [],
+            'mention_roles': [],
+            'mention_everyone': False,
+            'pinned': False,
+            'tts': False,
+            'timestamp': '2021-01-01T00:00:00+00:00',
+            'edited_timestamp': None,
+            'flags': 0,
+            'components': [],
+            **(body if isinstance(body, dict) else {}),
+        }
+
+    async def handle(self, request):
+        path = request.match_info['path']
+        self.requests[route_template(request.method, path)] += 1
+        body = None
+        if request.content_type == 'application/json' and request.can_read_body:
+            body = await request.json()
+
+        if request.method == 'DELETE' or path.endswith('/callback') or '/roles/' in path:
+            return aiohttp.web.Response(status=204)
+        if path.startswith('users/'):
+            return aiohttp.web.json_response(FAKE_USER)
+        if path.endswith('/commands'):
+            if request.method == 'GET':
+                return aiohttp.web.json_response([])
+            if request.method == 'PUT':
+                return aiohttp.web.json_response([{**c, 'id': str(next(self.ids))} for c in body or []])
+            return aiohttp.web.json_response({**(body or {}), 'id': str(next(self.ids))})
+        if path.startswith('webhooks/') or '/messages' in path:
+            return aiohttp.web.json_response(self.message(body))
+        return aiohttp.web.json_response({})
+
+class Replay(frobo.Cog):
+    '''
+    Records gateway payloads received by the Discord client to the file set
+    in discord.record, and feeds recordings back through the client against a
+    fake Discord API to measure how fast events are handled
+    '''
+
+    dependencies = ['cli', 'config', 'discord.client']
+
+    config: config.manager
+    client: discord.client
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        self.buffer = []
+        self.recording = self.config.get('discord.record')
+
+    @core.event('core.unmount')
+    async def on_unmount(self):
+        await self.flush()
+
+    @core.event('discord.socket_response')
+    async def record(self, msg):
+        if self.recording is not None:
+            self.buffer.append(json.dumps({'at': time.time(), 'payload': msg}) + '\n')
+
+    @core.periodic(interval=1)
+    async def flush(self):
+        if len(self.buffer) == 0:
+            return
+        lines, self.buffer = self.buffer, []
+        await self.core.loop.run_in_executor(None, self.write_lines, lines)
+
+    def write_lines(self, lines):
+        with open(self.recording, 'a') as f:
+            f.writelines(lines)
+
+    def load(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip() != '']
+
+    async def feed(self, msg, latencies):
+        '''
+        Dispatch a payload the way the gateway does, then wait for all of the
+        event handlers it triggered to measure how long it took
+        '''
+        client = self.client.client
+        tasks = []
+        token = client.tracked.set(tasks)
+        start = time.perf_counter()
+        try:
+            client.dispatch('socket_response', msg)
+            if msg.get('op') == 0 and msg.get('t') in client._connection.parsers:
+                client._connection.parsers[msg['t']](msg['d'])
+        finally:
+            client.tracked.reset(token)
+
+        # Handlers may schedule more events while we wait
+        waited = 0
+        while waited < len(tasks):
+            pending = tasks[waited:]
+            waited = len(tasks)
+            await asyncio.gather(*pending, return_exceptions=True)
+        latencies[msg.get('t') or f'op {msg.get("op")}'].observe(time.perf_counter() - start)
+
+    @cli.command('replay', 'Replay recorded gateway events (at 1, 10... times their speed, or max) against a fake Discord API', daemon=False)
+    async def replay(self, path, speed='1'):
+        factor = None if speed == 'max' else float(speed)
+        records = self.load(path)
+        self.recording = None
+
+        api = FakeApi()
+        base = await api.start()
+        discord.http.Route.BASE = f'{base}/api/v7'
+        discord_slash.http.CustomRoute.BASE = f'{base}/api/v8'
+        client = self.client.client
+        # There is no gateway connection to request guild members through
+        client._connection._chunk_guilds = False
+        await client.login('replay')
+
+        latencies = collections.defaultdict(lambda: frobo.util.Histogram(LATENCY_BOUNDS))
+        feeds = []
+        start = time.perf_counter()
+        first = records[0]['at'] if len(records) > 0 else 0
+        for record in records:
+            if factor is not None:
+                delay = (record['at'] - first) / factor - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            feeds.append(self.core.loop.create_task(self.feed(record['payload'], latencies)))
+            if factor is None:
+                # Still let handlers run between payloads
+                await asyncio.sleep(0)
+        await asyncio.gather(*feeds)
+        elapsed = time.perf_counter() - start
+
+        await client.http.close()
+        await api.stop()
+
+        print(f'Replayed {len(records)} events in {elapsed:.2f}s ({len(records) / elapsed if elapsed > 0 else 0:.1f} events/s)\n')
+        print(f'{"Event":32s} {"Count":>7s} {"p50":>9s} {"p99":>9s} {"Max":>9s}')
+        for name, histogram in sorted(latencies.items(), key=lambda item: -item[1].count):
+            summary = histogram.summary()
+            print(
+                f'{name[:32]:32s} {summary["count"]:7d} {summary["p50"] * 1000:7.2f}ms'
+                f' {summary["p99"] * 1000:7.2f}ms {summary["max"] * 1000:7.2f}ms'
+            )
+        print(f'\n{"Fake API route":56s} {"Requests":>8s}')
+        for route, count in api.requests.most_common():
+            print(f'{route[:56]:56s} {count:8d}')
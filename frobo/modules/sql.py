@@ -1,5 +1,170 @@
 import frobo
+import inspect
+import json
+import os
 import sqlalchemy, sqlalchemy.orm
+import time
+import warnings
+
+def index_name(table_name, columns):
+    return f'ix_{table_name}_{"_".join(columns)}'
+
+class Migrator:
+    '''
+    Schema operations available to migrations, all of them idempotent so that
+    they can run against tables that were created in their final shape
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def has_table(self, table_name):
+        return sqlalchemy.inspect(self.connection).has_table(table_name)
+
+    def reflect(self, table_name):
+        return sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload_with=self.connection)
+
+    def create_index(self, table_name, *columns, name=None, unique=False):
+        table = self.reflect(table_name)
+        index = sqlalchemy.Index(
+            name or index_name(table_name, columns),
+            *(table.c[column] for column in columns),
+            unique=unique,
+        )
+        index.create(self.connection, checkfirst=True)
+
+    def add_column(self, table_name, column):
+        table = self.reflect(table_name)
+        if column.name in table.c:
+            return
+        sqlalchemy.Table(table_name, sqlalchemy.MetaData(), column)
+        preparer = self.connection.dialect.identifier_preparer
+        spec = sqlalchemy.schema.CreateColumn(column).compile(dialect=self.connection.dialect)
+        self.connection.execute(sqlalchemy.text(f'ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {spec}'))
+
+    def drop_table(self, table_name):
+        sqlalchemy.Table(table_name, sqlalchemy.MetaData()).drop(self.connection, checkfirst=True)
+
+class MemoryStore:
+    '''
+    Keeps ephemeral entries in a dictionary, optionally saving them to a file
+    so that they survive restarts
+    '''
+
+    def __init__(self, path=None):
+        self.entries = {}
+        self.path = path
+        self.dirty = False
+
+    def get(self, namespace, key):
+        entry = self.entries.get((namespace, key), None)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self.delete(namespace, key)
+            return None
+        return entry[1]
+
+    def put(self, namespace, key, value, ttl):
+        self.entries[(namespace, key)] = (time.time() + ttl, value)
+        self.dirty = True
+
+    def pop(self, namespace, key):
+        value = self.get(namespace, key)
+        self.delete(namespace, key)
+        return value
+
+    def delete(self, namespace, key):
+        if self.entries.pop((namespace, key), None) is not None:
+            self.dirty = True
+
+    def sweep(self):
+        now = time.time()
+        expired = [k for k, (expires, _) in self.entries.items() if expires <= now]
+        for namespace, key in expired:
+            self.delete(namespace, key)
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        now = time.time()
+        self.entries = {(n, k): (expires, value) for n, k, expires, value in entries if expires > now}
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        self.dirty = False
+        entries = [[n, k, expires, value] for (n, k), (expires, value) in self.entries.items()]
+        # Never leave a truncated file behind if we get killed while writing
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+class SqlStore:
+    '''
+    Keeps ephemeral entries in a table, for them to be shared by processes
+    '''
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+
+    def where(self, namespace, key):
+        return sqlalchemy.and_(self.table.c.namespace == namespace, self.table.c.key == key)
+
+    def get(self, namespace, key):
+        with self.engine.connect() as connection:
+            row = connection.execute(sqlalchemy.select(self.table.c.value, self.table.c.expires).where(self.where(namespace, key))).first()
+        if row is None or row.expires <= time.time():
+            return None
+        return json.loads(row.value)
+
+    def put(self, namespace, key, value, ttl):
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.delete(self.table).where(self.where(namespace, key)))
+            connection.execute(sqlalchemy.insert(self.table).values(
+                namespace=namespace,
+                key=key,
+                value=json.dumps(value),
+                expires=time.time() + ttl,
+            ))
+
+    def pop(self, namespace, key):
+        with self.engine.begin() as connection:
+            row = connection.execute(sqlalchemy.select(self.table.c.value, self.table.c.expires).where(self.where(namespace, key))).first()
+            if row is None:
+                return None
+            # Only the caller whose delete matched the row it read gets the value
+            result = connection.execute(
+                sqlalchemy.delete(self.table)
+                    .where(self.where(namespace, key))
+                    .where(self.table.c.value == row.value)
+                    .where(self.table.c.expires == row.expires)
+            )
+            if result.rowcount != 1:
+                return None
+        if row.expires <= time.time():
+            return None
+        return json.loads(row.value)
+
+    def delete(self, namespace, key):
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.delete(self.table).where(self.where(namespace, key)))
+
+    def sweep(self):
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.delete(self.table).where(self.table.c.expires <= time.time()))
+
+    def load(self):
+        pass
+
+    def save(self):
+        pass
 
 class Database(frobo.Cog):
     dependencies = ['config', 'cli']
@@ -9,15 +174,49 @@ class Database(frobo.Cog):
     @core.event('core.mount')
     async def on_mount(self):
         uri = self.config.get('sql.uri', 'sqlite:///:memory:')
-        echo = bool(self.config.get('sql.echo', False))
-        self.engine = sqlalchemy.create_engine(uri, echo=echo)
+        echo = self.config.get_bool('sql.echo', False)
+        options = {}
+        url = sqlalchemy.engine.make_url(uri)
+        if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+            # Share the in-memory database with all threads, rather than having
+            # one per thread whose connection cannot be closed from another
+            options = dict(poolclass=sqlalchemy.pool.StaticPool, connect_args={'check_same_thread': False})
+        self.engine = sqlalchemy.create_engine(uri, echo=echo, **options)
         self.Base = sqlalchemy.orm.declarative_base()
+        self.migrations = sqlalchemy.Table(
+            'frobo_migrations',
+            self.Base.metadata,
+            sqlalchemy.Column('cog', sqlalchemy.String, primary_key=True),
+            sqlalchemy.Column('version', sqlalchemy.Integer, nullable=False),
+        )
+        # Maps the field classes of sql.model registrations to their models,
+        # as columns cannot be given to more than one table
+        self.models = {}
+        # Maps the tables of the models of unmounted cogs to their field classes
+        # and the module defining them, until their module is unloaded or
+        # reloaded, or they are mounted again
+        self.retired = {}
 
     @core.event('core.mounted')
     async def on_mounted(self, cog):
         for reg in self.core.registered('sql.model', only=[cog.qualname]):
             pass
 
+    @core.event('core.unmounting')
+    async def on_unmounting(self, cog):
+        unloading = cog.qualname[:-1] in frobo.kernel.module.unloading_modules.get()
+        for reg in self.core.registered('sql.model', only=[cog.qualname]):
+            if unloading:
+                # Nothing can mount the cog again, forget its models, which
+                # cogs required by others of the same module get asked twice
+                self.retired.pop(reg.wrapped.__tablename__, None)
+                model = self.models.pop(reg.raw, None)
+                if model is not None:
+                    self.Base.metadata.remove(model.__table__)
+            else:
+                # Reloading the cog defines its models anew, replacing these ones
+                self.retired[reg.wrapped.__tablename__] = (reg.raw, cog.module)
+
     @core.event('core.unmount')
     async def on_unmount(self):
         self.engine.dispose()
@@ -25,17 +224,138 @@ class Database(frobo.Cog):
 
 
     @core.transform('sql.model')
-    def make_model(self, reg, fields, table_name=None):
+    def make_model(self, reg, fields, table_name=None, indexes=()):
+        model = self.models.get(fields, None)
+        if model is not None:
+            # The same cog is being mounted again
+            self.retired.pop(model.__tablename__, None)
+            return model
+
+        # Drop every table of reloaded modules before building any new model, as
+        # foreign keys of the new models would resolve against the old tables
+        for name, (retired, module) in list(self.retired.items()):
+            if self.core.modules.get(module.name, None) is not module:
+                del self.retired[name]
+                self.Base.metadata.remove(self.models.pop(retired).__table__)
+
         table_name = table_name or frobo.util.camel_to_snakecase(fields.__name__)
-        return type(fields.__name__, (fields, self.Base,), {'__tablename__': table_name, **fields.__annotations__})
+        attributes = {'__tablename__': table_name, **fields.__annotations__}
+        if len(indexes) > 0:
+            columns = [(index,) if isinstance(index, str) else tuple(index) for index in indexes]
+            attributes['__table_args__'] = tuple(sqlalchemy.Index(index_name(table_name, c), *c) for c in columns)
+        previous = self.retired.pop(table_name, None)
+        if previous is not None:
+            self.Base.metadata.remove(self.models.pop(previous[0]).__table__)
+        with warnings.catch_warnings():
+            # Models of reloaded or unloaded cogs are only replaced once garbage
+            # collected
+            warnings.filterwarnings('ignore', 'This declarative base already contains', sqlalchemy.exc.SAWarning)
+            model = self.models[fields] = type(fields.__name__, (fields, self.Base,), attributes)
+        return model
 
     @core.injectable('sql.session')
     def get_session(self):
         return sqlalchemy.orm.Session(self.engine)
 
-    @cli.command('init', 'Create tables in database', daemon=False)
-    async def on_init(self):
+    async def migrate(self):
+        '''
+        Create missing tables, then apply the sql.migration registrations of
+        every cog that are newer than the version recorded for it
+        '''
         models = list(map(lambda r: r.wrapped.__bases__, self.core.registered('sql.model')))
         self.Base.metadata.create_all(self.engine)
+        with self.engine.connect() as connection:
+            applied = dict(connection.execute(sqlalchemy.select(self.migrations)).all())
+
+        for qualname in list(self.core.cogs.keys()):
+            cog_name = '.'.join(qualname)
+            migrations = sorted(self.core.registered('sql.migration', only=[qualname]), key=lambda r: r.args[0])
+            for reg in migrations:
+                version = reg.args[0]
+                if version <= applied.get(cog_name, 0):
+                    continue
+                with self.engine.begin() as connection:
+                    result = reg.wrapped(Migrator(connection))
+                    if inspect.isawaitable(result):
+                        await result
+                    if cog_name in applied:
+                        query = sqlalchemy.update(self.migrations).where(self.migrations.c.cog == cog_name)
+                    else:
+                        query = sqlalchemy.insert(self.migrations).values(cog=cog_name)
+                    connection.execute(query.values(version=version))
+                applied[cog_name] = version
+                description = reg.args[1] if len(reg.args) > 1 else reg.raw.__name__
+                print(f'Applied migration {version} of {cog_name}: {description}')
+
+    @cli.command('init', 'Create tables in database', daemon=False)
+    async def on_init(self):
+        await self.migrate()
         print('Tables created')
-        
\ No newline at end of file
+
+    @cli.command('migrate', 'Upgrade existing tables in database', daemon=False)
+    async def on_migrate(self):
+        await self.migrate()
+        print('Database up to date')
+
+class Ephemeral(frobo.Cog):
+    '''
+    Stores short-lived, JSON serializable values by namespace and key, each
+    of them expiring after its own time to live
+
+    Values are kept in memory by default, and saved to sql.ephemeral.path when
+    set, or in the database when sql.ephemeral.backend is "sql", which is the
+    default when web workers need to share them with the primary process
+    '''
+
+    dependencies = ['config', 'sql.database']
+
+    config: config.manager
+    database: sql.database
+
+    @sql.model('frobo_ephemeral', indexes=['expires'])
+    class Entry:
+        namespace: sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        key      : sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        value    : sqlalchemy.Column(sqlalchemy.Text)
+        expires  : sqlalchemy.Column(sqlalchemy.Float)
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        default = 'sql' if self.config.get_int('web.workers', 1) > 1 else 'memory'
+        backend = self.config.get('sql.ephemeral.backend', default)
+        if backend == 'memory':
+            self.store = MemoryStore(self.config.get('sql.ephemeral.path'))
+        elif backend == 'sql':
+            self.store = SqlStore(self.database.engine, self.Entry.__table__)
+        else:
+            raise ValueError(f'Invalid ephemeral store backend: {backend}')
+        # A shared store is swept by the process connecting the first shard
+        # only, when shards are spread across processes
+        shard_ids = [int(i) for i in self.config.get_list('discord.shard-ids')]
+        self.sweeps = backend == 'memory' or len(shard_ids) == 0 or 0 in shard_ids
+        self.store.load()
+
+    @core.event('core.unmount')
+    async def on_unmount(self):
+        self.store.save()
+
+    @core.periodic(interval=30)
+    async def sweep(self):
+        if self.sweeps:
+            self.store.sweep()
+        self.store.save()
+
+    def get(self, namespace: str, key: str):
+        return self.store.get(namespace, key)
+
+    def put(self, namespace: str, key: str, value, ttl: float):
+        self.store.put(namespace, key, value, ttl)
+
+    def pop(self, namespace: str, key: str):
+        '''
+        Remove an entry, returning its value if it had not expired
+        '''
+        return self.store.pop(namespace, key)
+
+    def delete(self, namespace: str, key: str):
+        self.store.delete(namespace, key)
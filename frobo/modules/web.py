@@ -1,33 +1,306 @@
 import aiohttp.web
+import asyncio
+import collections
+import datetime
 import frobo
+import functools
+import multiprocessing
+import signal
+import sys
+import time
+
+class RouteStats:
+    def __init__(self):
+        self.latency = frobo.util.Histogram()
+        self.statuses = collections.Counter()
+        self.in_flight = 0
+
+    def summary(self):
+        return {
+            'in_flight': self.in_flight,
+            'statuses': dict(self.statuses),
+            'latency': self.latency.summary(),
+        }
+
+class AccessLog:
+    '''
+    Buffers access log lines in memory and writes them in batches from an
+    executor, so that logging never blocks request handling
+
+    Lines are dropped, and counted as such, when the buffer is full
+    '''
+
+    def __init__(self, loop, path, batch_size=256, interval=1.0, limit=65536):
+        self.loop = loop
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.limit = limit
+        self.buffer = []
+        self.dropped = 0
+        self.lock = asyncio.Lock()
+        self.pending = None
+        self.task = loop.create_task(self.run())
+
+    def write(self, line: str):
+        if len(self.buffer) >= self.limit:
+            self.dropped += 1
+            return
+        self.buffer.append(line)
+        if len(self.buffer) >= self.batch_size and self.pending is None:
+            self.pending = self.loop.create_task(self.flush())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            self.pending = None
+            if len(self.buffer) == 0:
+                return
+            lines, self.buffer = self.buffer, []
+            await self.loop.run_in_executor(None, self.write_lines, lines)
+
+    def write_lines(self, lines: list[str]):
+        if self.path == '-':
+            sys.stdout.writelines(lines)
+            sys.stdout.flush()
+        else:
+            with open(self.path, 'a') as f:
+                f.writelines(lines)
+
+    async def close(self):
+        self.task.cancel()
+        await self.flush()
 
 class Server(frobo.Cog):
+    '''
+    Serves the web.route registrations of all cogs
+
+    When web.workers is above 1, requests are served by as many child
+    processes sharing the port through SO_REUSEPORT, each of them only
+    mounting the cogs that register routes, while the primary process keeps
+    running everything else
+    '''
+
     dependencies = ['cli', 'config']
 
     config: config.manager
 
     @core.event('core.mount')
     async def on_mount(self):
-        self.app = aiohttp.web.Application()
+        self.app = aiohttp.web.Application(middlewares=[self.instrument])
+        self.stats = {}
+        self.access_log = None
+        if self.config.get('web.access-log') is not None:
+            self.access_log = AccessLog(self.core.loop, self.config.get('web.access-log'))
+        # Maps (method, path) to the cog serving it and its handler, if mounted
+        self.handlers = {}
+        self.routed = []
+        self.relay = None
+        self.workers = {}
+        # Maps worker indexes to futures resolved when their process exits
+        self.exits = {}
+        self.supervisors = []
+        self.stopping = False
 
     @core.event('core.unmount')
     async def on_unmount(self):
-        if hasattr(self, 'site'):
-            await self.site.stop()
+        self.stopping = True
+        if hasattr(self, 'runner'):
+            await self.runner.cleanup()
+        await self.stop_workers()
+        if self.access_log is not None:
+            await self.access_log.close()
 
     @core.event('core.mounted')
     async def on_mounted(self, cog):
-        # NOTE: We will need to redo this to implement unmounting
         for reg in self.core.registered('web.route', only=[cog.qualname]):
-            self.app.router.add_route(*reg.args, reg.wrapped, **reg.kwargs)
+            key = tuple(reg.args[:2])
+            if key not in self.handlers:
+                try:
+                    self.app.router.add_route(*key, functools.partial(self.handle, key), **reg.kwargs)
+                except RuntimeError as e:
+                    # Routes cannot be added once the server started
+                    print(f'\033[91;1mCould not route {" ".join(key)} for {".".join(cog.qualname)}: {e}\033[0m')
+                    continue
+            self.handlers[key] = (cog.qualname, reg.wrapped)
+            if cog.qualname not in self.routed:
+                self.routed.append(cog.qualname)
 
-    # TODO: @core.event('core.unmounting')
+    @core.event('core.unmounting')
+    async def on_unmounting(self, cog):
+        # Routes stay in the router, but answer 404 until mounted again
+        for key, (qualname, _) in list(self.handlers.items()):
+            if qualname == cog.qualname:
+                self.handlers[key] = (qualname, None)
+        if cog.qualname in self.routed:
+            self.routed.remove(cog.qualname)
 
-    @cli.command('start', 'Listen for and serve web requests')
-    async def start(self):
+    async def handle(self, key, request):
+        '''
+        Call the handler currently mounted for a route, so that cogs can be
+        reloaded while the server runs
+        '''
+        _, handler = self.handlers[key]
+        if handler is None:
+            raise aiohttp.web.HTTPNotFound()
+        return await handler(request)
+
+    @aiohttp.web.middleware
+    async def instrument(self, request, handler):
+        resource = request.match_info.route.resource
+        template = resource.canonical if resource is not None else '<unmatched>'
+        stats = self.stats.get(template, None)
+        if stats is None:
+            stats = self.stats[template] = RouteStats()
+
+        stats.in_flight += 1
+        status = 500
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except aiohttp.web.HTTPException as e:
+            status = e.status
+            raise e
+        except asyncio.CancelledError as e:
+            # The client went away before we could answer
+            status = 499
+            raise e
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.in_flight -= 1
+            stats.latency.observe(elapsed)
+            stats.statuses[status] += 1
+            if self.access_log is not None:
+                self.access_log.write(
+                    f'{datetime.datetime.now().isoformat(timespec="seconds")} {request.remote} '
+                    f'"{request.method} {request.path_qs}" {status} {elapsed * 1000:.1f}ms\n'
+                )
+
+    @core.injectable('web.stats')
+    def get_stats(self):
+        '''
+        Return request statistics per route template for this process
+        '''
+        return {template: stats.summary() for template, stats in self.stats.items()}
+
+    async def dispatch(self, name: str, *args):
+        '''
+        Emit an event in the primary process, letting route handlers reach
+        cogs that only run there, like the Discord client, from workers
+        '''
+        if self.relay is None:
+            await self.core.emit(name, *args)
+        else:
+            self.relay.send((name, args))
+
+    def receive(self, relay):
+        try:
+            name, args = relay.recv()
+        except EOFError:
+            self.core.loop.remove_reader(relay.fileno())
+            return
+        self.core.loop.create_task(self.core.emit(name, *args))
+
+    async def serve(self, reuse_port: bool=False):
         host = self.config.get('web.host', '0.0.0.0')
-        port = self.config.get('web.port', 8080)
-        self.runner = aiohttp.web.AppRunner(self.app)
+        port = self.config.get_int('web.port', 8080)
+        self.runner = aiohttp.web.AppRunner(self.app, access_log=None)
         await self.runner.setup()
-        self.site = aiohttp.web.TCPSite(self.runner, host, port)
-        await self.site.start()
\ No newline at end of file
+        self.site = aiohttp.web.TCPSite(
+            self.runner,
+            host,
+            port,
+            shutdown_timeout=self.config.get_float('web.shutdown-timeout', 10.0),
+            reuse_port=reuse_port or None,
+        )
+        await self.site.start()
+
+    async def supervise(self, index: int):
+        '''
+        Run a worker process, restarting it with an increasing delay whenever
+        it exits unexpectedly
+        '''
+        context = multiprocessing.get_context('spawn')
+        delay = 1
+        while not self.stopping:
+            receiver, sender = context.Pipe(duplex=False)
+            process = self.workers[index] = context.Process(
+                target=frobo.kernel.core.run_child,
+                args=(self.core.path, ['web-worker', sender], self.routed, self.core.backend, self.core.unmount_timeout),
+                name=f'frobo-web-{index}',
+                daemon=True,
+            )
+            process.start()
+            sender.close()
+            self.core.loop.add_reader(receiver.fileno(), self.receive, receiver)
+            started = self.core.loop.time()
+
+            self.exits[index] = self.watch_exit(process)
+            await self.exits[index]
+            self.core.loop.remove_reader(receiver.fileno())
+            receiver.close()
+            if self.stopping:
+                break
+            if self.core.loop.time() - started > 60:
+                delay = 1
+            print(f'\033[91;1mWeb worker {index} exited with code {process.exitcode}, restarting in {delay}s\033[0m')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def watch_exit(self, process) -> asyncio.Future:
+        '''
+        Return a future resolved with the exit code of a process once it exits,
+        watching its sentinel from the event loop rather than joining it from a
+        thread
+        '''
+        future = self.core.loop.create_future()
+        def exited():
+            self.core.loop.remove_reader(process.sentinel)
+            process.join()
+            if not future.done():
+                future.set_result(process.exitcode)
+        self.core.loop.add_reader(process.sentinel, exited)
+        return future
+
+    async def stop_workers(self):
+        '''
+        Ask workers to finish their in-flight requests and exit, killing the
+        ones still running after their shutdown timeout
+        '''
+        processes = [p for p in self.workers.values() if p.is_alive()]
+        for process in processes:
+            process.terminate()
+        timeout = self.config.get_float('web.shutdown-timeout', 10.0) + 5
+        try:
+            await asyncio.wait_for(
+                self.core.gather(asyncio.shield(future) for future in self.exits.values()),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.is_alive():
+                    process.kill()
+        await self.core.gather(self.supervisors, return_exceptions=True)
+
+    @cli.command('start', 'Listen for and serve web requests')
+    async def start(self):
+        workers = self.config.get_int('web.workers', 1)
+        if workers <= 1:
+            await self.serve()
+            return
+        for index in range(workers):
+            self.supervisors.append(self.core.loop.create_task(self.supervise(index)))
+
+    @cli.command('web-worker', 'Serve web requests on behalf of a primary process')
+    async def serve_worker(self, relay):
+        # The primary process coordinates shutdown, so ignore Ctrl-C here
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.core.loop.add_signal_handler(signal.SIGTERM, self.core.loop.stop)
+        self.relay = relay
+        await self.serve(reuse_port=True)
@@ -0,0 +1,30 @@
+import frobo
+import os
+import unittest
+import unittest.mock
+
+class ProfileColumnTest(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(os.environ, {'FROBO_SQL_URI': 'sqlite://'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.core = frobo.Core([])
+        self.addCleanup(lambda: self.core.loop.run_until_complete(self.core._close()))
+        self.core.loop.run_until_complete(self.core.load_module(name=('discord',)))
+        self.helpers = self.core.modules[('discord',)].module
+
+    def assertMatchesReference(self, profiles, key, condition, expected):
+        column = self.helpers.ProfileColumn(profiles, key)
+        found = list(column.test(condition, expected))
+        reference = [self.helpers.do_test(self.helpers.get_profile_value(p, key), condition, expected) for p in profiles]
+        self.assertEqual(found, reference, f'{key} {condition} {expected!r}')
+
+    def test_large_integers(self):
+        # Past 2**53, integers and bounds are not exact as floats
+        profiles = [{'a': 2 ** 53 + 1}, {'a': 2 ** 53}, {'a': -2 ** 53 - 1}, {'a': float(2 ** 53)}, {'a': 3}]
+        for bound in (2 ** 53, 2 ** 53 + 1, 2 ** 53 + 2, -2 ** 53 - 2, 4):
+            for condition in ('<', '>'):
+                self.assertMatchesReference(profiles, 'a', condition, str(bound))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+import contextlib
+import frobo
+import io
+import os
+import pathlib
+import tempfile
+import textwrap
+import unittest
+import unittest.mock
+
+MODULE = '''
+import asyncio
+import frobo
+import time
+
+class Slow(frobo.Cog):
+    dependencies = ['cli', 'monitor.loop']
+
+    monitor: monitor.loop
+
+    @core.event('core.mount')
+    async def on_mount(self):
+        # Like a module doing heavy work when imported or mounted
+        time.sleep(0.5)
+
+    @cli.command('idle', 'Let the monitor take a few samples', daemon=False)
+    async def idle(self, block='0'):
+        await asyncio.sleep(0.3)
+        time.sleep(float(block))
+        await asyncio.sleep(0.3)
+        self.core.stalls = self.monitor.stalls
+'''
+
+class LoopTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        (pathlib.Path(directory.name) / 'slow.py').write_text(textwrap.dedent(MODULE))
+        patcher = unittest.mock.patch.dict(os.environ, {'FROBO_SQL_URI': 'sqlite://'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Core.run leaves its loop stopped, do not share it with other tests
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.core = frobo.Core([pathlib.Path(directory.name)], loop=loop)
+
+    def run_idle(self, block: float) -> str:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.core.run(['idle', str(block)], exit=False, cogs=['slow.slow'])
+        return output.getvalue()
+
+    def test_startup_is_not_a_stall(self):
+        output = self.run_idle(0)
+        self.assertEqual(self.core.stalls, 0)
+        self.assertNotIn('Event loop blocked', output)
+
+    def test_stall_after_startup(self):
+        output = self.run_idle(0.5)
+        self.assertEqual(self.core.stalls, 1)
+        self.assertIn('Event loop blocked', output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import frobo
+import os
+import unittest
+import unittest.mock
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(os.environ, {'FROBO_SQL_URI': 'sqlite://'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.core = frobo.Core([])
+        self.addCleanup(lambda: self.core.loop.run_until_complete(self.core._close()))
+
+    def test_reload_linked_models(self):
+        # Rule and Condition are linked by a foreign key
+        async def run():
+            await self.core.mount_cog('discord.roles')
+            for _ in range(2):
+                await self.core.reload_module(name=('discord',))
+            roles = self.core.cogs[('discord', 'roles')]
+            foreign_key, = roles.Condition.__table__.c.rule_id.foreign_keys
+            self.assertIs(foreign_key.column.table, roles.Rule.__table__)
+            database = self.core.cogs[('sql', 'database')]
+            self.assertIs(database.Base.metadata.tables['rules'], roles.Rule.__table__)
+            await database.migrate()
+        self.core.loop.run_until_complete(run())
+
+    def test_unload_forgets_models(self):
+        async def run():
+            await self.core.mount_cog('discord.roles')
+            database = self.core.cogs[('sql', 'database')]
+            await self.core.unload_module(('discord',))
+            self.assertNotIn('rules', database.Base.metadata.tables)
+            self.assertEqual(database.retired, {})
+        self.core.loop.run_until_complete(run())
+
+if __name__ == '__main__':
+    unittest.main()